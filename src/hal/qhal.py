@@ -3,96 +3,616 @@
 
 """Handles the SuperIO chip and other I/O operations unique to QNAP NAS devices."""
 
-import ast
-from collections import namedtuple
+from array import array
+import bisect
+from collections import deque, namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+import heapq
 import io
+import itertools
+import json
+import math
 import os
 from pathlib import Path
-from subprocess import DEVNULL, Popen, PIPE, run
-from serial import Serial
+from subprocess import DEVNULL, Popen, PIPE, TimeoutExpired, run
 import argparse
+import select
+import selectors
+import shlex
 import socket
-import daemon
+import sys
 import signal
 import logging
-from portio import ioperm, inb, outb
-from dotenv import load_dotenv
+import queue
+import threading
+import time
+
+# Reference point of the startup budget
+STARTED = time.monotonic()
 
 # Define some values for the supported HAL features
 IO = namedtuple('IO', ['name', 'port', 'bit'])
 SOUND = namedtuple('SOUND', ['name', 'id'])
-SENSOR = namedtuple('SENSOR', ['name'])
-
-# Define the list of LEDs
-# Apparently the first two disks have access to a blinking LED, via I2C.
-leds = [
-  IO(name='Status_Green', port=0x91, bit=2),
-  IO(name='Status_Red', port=0x91, bit=3),
-  IO(name='Front_USB', port=0xE1, bit=7),
-  IO(name='Disk1_Present', port=0xB1, bit=2),
-  IO(name='Disk2_Present', port=0xB1, bit=3),
-  IO(name='Disk1_Error', port=0x81, bit=0),
-  IO(name='Disk2_Error', port=0x81, bit=1),
-  IO(name='Disk3_Error', port=0x81, bit=2),
-  IO(name='Disk4_Error', port=0x81, bit=3),
-  IO(name='Disk5_Error', port=0x81, bit=4),
-  IO(name='Disk6_Error', port=0x81, bit=5),
-]
-
-# Define the list of buttons
-buttons = [
-  IO(name='Reset', port=0x92, bit=1),
-  IO(name='USB_Copy', port=0xE2, bit=2),
-]
-
-# Define the list of sounds the buzzer can generate
-#
-# List of supported sounds comes from:
-# https://sandrotosi.blogspot.com/2021/05/qnap-control-lcd-panel-and-speaker.html
-sounds = [
-  SOUND(name='Beep', id=0),
-  SOUND(name='Online', id=1),
-  SOUND(name='Ready', id=2),
-  SOUND(name='Alert', id=3),
-  SOUND(name='Outage', id=8),
-  SOUND(name='Completed', id=12),
-  SOUND(name='Error', id=14),
-]
-
-temps = [
-  SENSOR(name='CPU'),
-  SENSOR(name='Eth2'),
-  SENSOR(name='Temp1'),
-  SENSOR(name='Temp2'),
-  SENSOR(name='Temp3'),
-]
-
-fans = [
-  SENSOR(name='Fan1'),
-  SENSOR(name='Fan2'),
-]
-
-SOCKET_PATH = '/tmp/qhal_daemon.sock'
-PID_FILE = '/tmp/qhal_daemon.pid'
-SOCKET_TIMEOUT = 0.1
+SENSOR = namedtuple('SENSOR', ['name', 'chip', 'key'])
+
+# Hardware description of the QNAP model, read from data/hal/<model>.json
+MODEL = os.environ.get('QHAL_MODEL', 'tvs-663')
+HARDWARE_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                             '..', '..', 'data', 'hal'))
+
+
+class HardwareMap:
+  """Hardware description of a QNAP model, compiled into lookup tables.
+
+  The lists keep the order of the description. Each kind of entry is also
+  indexed by name, and the LEDs and buttons are grouped per register, so
+  batched I/O visits each register once without working out its bits again.
+  """
+
+  KINDS = {'leds': IO, 'buttons': IO, 'sounds': SOUND, 'temps': SENSOR, 'fans': SENSOR}
+
+  def __init__(self, description, source='<description>'):
+    """Init."""
+    self.model = description.get('model', source)
+    for kind, entry_type in self.KINDS.items():
+      try:
+        entries = [entry_type(**{field: self.__value(field, entry[field])
+                                 for field in entry_type._fields})
+                   for entry in description.get(kind, [])]
+      except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid {kind} in {source}: {e}')
+      index = {entry.name: entry for entry in entries}
+      if len(index) != len(entries):
+        raise ValueError(f'Duplicate {kind} names in {source}')
+      setattr(self, kind, entries)
+      # e.g. self.led['Status_Red']
+      setattr(self, kind[:-1], index)
+
+    self.sensors = self.temps + self.fans
+    self.sensor = dict(self.temp, **self.fan)
+    self.fan_control = description.get('fan_control', {})
+    self.alerts = description.get('alerts', [])
+    self.button_groups = self.group(self.buttons)
+
+  @staticmethod
+  def group(ios):
+    """Group I/Os per register: ((port, ((io, mask), ...)), ...)."""
+    groups = {}
+    for pin in ios:
+      groups.setdefault(pin.port, []).append((pin, 1 << pin.bit))
+    return tuple((port, tuple(members)) for port, members in groups.items())
+
+  @staticmethod
+  def __value(field, value):
+    # Registers are easier to read in hexadecimal, which JSON lacks
+    if field == 'port' and isinstance(value, str):
+      return int(value, 0)
+    return value
+
+
+def load_hardware(model=MODEL, directory=HARDWARE_DIR):
+  """Load and compile the hardware description of a model."""
+  filename = os.path.join(directory, f'{model}.json')
+  if not os.path.exists(filename):
+    models = sorted(name[:-5] for name in os.listdir(directory) if name.endswith('.json'))
+    raise SystemExit(f'No hardware description for model {model},'
+                     f' known models: {", ".join(models)}')
+  with open(filename) as f:
+    return HardwareMap(json.load(f), filename)
+
+
+hardware = load_hardware()
+leds = hardware.leds
+buttons = hardware.buttons
+sounds = hardware.sounds
+temps = hardware.temps
+fans = hardware.fans
+
+# Overridable, so a simulated daemon can run next to the real one
+SOCKET_PATH = os.environ.get('QHAL_SOCKET', '/tmp/qhal_daemon.sock')
+PID_FILE = os.environ.get('QHAL_PID_FILE', '/tmp/qhal_daemon.pid')
+# Requests and responses are newline-delimited JSON objects. A single
+# request line may not exceed this size.
+MAX_REQUEST_SIZE = 64 * 1024
 
 IO_REG_PORT = 0xa05
 IO_REG_DATA = IO_REG_PORT + 1
 IO_REG_COUNT = 2
 
+LCD_PORT = '/dev/ttyS1'
+LCD_BAUDRATE = 1200
+LCD_ROWS = 2
+LCD_COLUMNS = 16
+
+HWMON_ROOT = '/sys/class/hwmon'
+
+# Resolved local.env values and hwmon index, relative to ROOT
+CONFIG_CACHE = '.cache/qhal_config.json'
+HWMON_CACHE = '.cache/qhal_hwmon.json'
+
+# Hardware to drive: 'real' for the QNAP itself, 'sim' for the simulator of
+# the qhalsim package, which runs on any Linux machine.
+BACKEND = os.environ.get('QHAL_BACKEND', 'real')
+
+
+def env_number(name, default):
+  """Read a numeric tunable from the environment."""
+  try:
+    return type(default)(os.environ.get(name, default))
+  except ValueError:
+    return default
+
+
+# Time the CLI may take to load, configure itself and parse its arguments
+# before handling the command, in seconds.
+STARTUP_BUDGET = env_number('QHAL_STARTUP_BUDGET', 0.1)
+
+# Daemon log files: size at which they are rotated, how many rotated files
+# are kept, and after how many days any log file of this program is removed.
+LOG_MAX_BYTES = env_number('QHAL_LOG_MAX_BYTES', 1024 * 1024)
+LOG_BACKUPS = env_number('QHAL_LOG_BACKUPS', 5)
+LOG_RETENTION_DAYS = env_number('QHAL_LOG_RETENTION_DAYS', 14.0)
+
+# Button sampling period, how long a level must hold before it is accepted,
+# and the durations telling long and double presses apart. In seconds.
+BUTTON_PERIOD = env_number('QHAL_BUTTON_PERIOD', 0.02)
+BUTTON_DEBOUNCE = env_number('QHAL_BUTTON_DEBOUNCE', 0.04)
+BUTTON_LONG_PRESS = env_number('QHAL_BUTTON_LONG_PRESS', 1.5)
+BUTTON_DOUBLE_PRESS = env_number('QHAL_BUTTON_DOUBLE_PRESS', 0.4)
+
+# Period of the LED test pattern, in seconds
+LED_PERIOD = 0.1
+
+# Resolution of the LED pattern timer wheel, in seconds, and its number of
+# slots. Edges further away than one turn of the wheel wait for extra turns.
+LED_TICK = env_number('QHAL_LED_TICK', 0.02)
+LED_WHEEL_SLOTS = env_number('QHAL_LED_WHEEL_SLOTS', 64)
+
+# Sounds waiting to be played by the daemon, and the window during which
+# requests for a sound already queued or playing are merged into it.
+BEEP_QUEUE_SIZE = env_number('QHAL_BEEP_QUEUE_SIZE', 8)
+BEEP_COALESCE = env_number('QHAL_BEEP_COALESCE', 1.0)
+
+# Commands bound to buttons: how many may run at once for the same button,
+# how long they may run before being killed, and how many finished jobs
+# are remembered for the 'jobs' command.
+JOB_CONCURRENCY = env_number('QHAL_JOB_CONCURRENCY', 1)
+JOB_TIMEOUT = env_number('QHAL_JOB_TIMEOUT', 600.0)
+JOB_HISTORY = env_number('QHAL_JOB_HISTORY', 32)
+
+# How often the daemon samples temps and fans, in seconds,
+# and how many samples of history it keeps for each of them.
+SENSOR_PERIOD = env_number('QHAL_SENSOR_PERIOD', 5.0)
+SENSOR_HISTORY = env_number('QHAL_SENSOR_HISTORY', 720)
+
+# Directory of the node_exporter textfile collector the daemon publishes its
+# metrics to, if any, and how often it does so in seconds.
+TEXTFILE_DIR = os.environ.get('QHAL_TEXTFILE_DIR')
+TEXTFILE_PERIOD = env_number('QHAL_TEXTFILE_PERIOD', 15.0)
+
+# Fan control: whether the daemon takes control of the fans when it starts,
+# and a JSON file overriding the fan_control section of the hardware map.
+FAN_CONTROL = env_number('QHAL_FAN_CONTROL', 0)
+FAN_CONFIG = os.environ.get('QHAL_FAN_CONFIG')
+# Hidden command running the process that gives the fans back to the
+# hardware when the daemon dies
+FAN_WATCHDOG = '_fan_watchdog'
+
+# JSON file overriding the alerts section of the hardware map
+ALERT_CONFIG = os.environ.get('QHAL_ALERT_CONFIG')
+
+# How long the notifications of a UPS settle before acting on them, in seconds
+UPS_SETTLE = env_number('QHAL_UPS_SETTLE', 2.0)
+
+# md RAID status, and how often it is read again even without a change
+# notification, in seconds. Block devices, to map RAID members to bays.
+MDSTAT_PATH = os.environ.get('QHAL_MDSTAT', '/proc/mdstat')
+MDSTAT_FALLBACK = env_number('QHAL_MDSTAT_FALLBACK', 60.0)
+SYS_BLOCK = '/sys/block'
+SYS_BLOCK_CLASS = '/sys/class/block'
+DISK_ERROR_LEDS = tuple(f'Disk{i}_Error' for i in range(1, 7))
+
+# Disk I/O statistics, the most that is read of them, and how often they are
+# sampled to blink the disk LEDs, in seconds (0 to leave the LEDs alone).
+DISKSTATS_PATH = os.environ.get('QHAL_DISKSTATS', '/proc/diskstats')
+DISKSTATS_MAX_SIZE = 64 * 1024
+DISK_ACTIVITY_PERIOD = env_number('QHAL_DISK_ACTIVITY_PERIOD', 0.05)
+
+# SMART data: how often it is refreshed, how many smartctl may run at once,
+# and how long each of them may take, in seconds.
+SMARTCTL = os.environ.get('QHAL_SMARTCTL', '/usr/sbin/smartctl')
+SMART_PERIOD = env_number('QHAL_SMART_PERIOD', 1800.0)
+SMART_WORKERS = env_number('QHAL_SMART_WORKERS', 4)
+SMART_TIMEOUT = env_number('QHAL_SMART_TIMEOUT', 60.0)
+
+# Events clients can subscribe to, and how many bytes of events may wait for
+# a subscriber before it is considered too slow and disconnected.
+EVENT_KINDS = ('button', 'led', 'sensor', 'job', 'alert', 'ups', 'raid')
+SUBSCRIBER_BUFFER = env_number('QHAL_SUBSCRIBER_BUFFER', 256 * 1024)
+
+
+class Metrics:
+  """Counters and latency histograms, grouped by subsystem.
+
+  Latencies are sorted in buckets growing by a factor of 4, from 16 us to
+  about 4 s, which is enough to tell a register access from a subprocess.
+  Safe to update from any thread.
+  """
+
+  BOUNDS = tuple(16e-6 * 4 ** i for i in range(10))
+
+  def __init__(self):
+    """Init."""
+    self.__lock = threading.Lock()
+    self.__counters = {}
+    # {(subsystem, name): [bucket counts, count, sum, max]}
+    self.__histograms = {}
+    self.__started = time.monotonic()
+
+  def count(self, subsystem, name, value=1):
+    """Add value to a counter."""
+    key = (subsystem, name)
+    with self.__lock:
+      self.__counters[key] = self.__counters.get(key, 0) + value
+
+  def observe(self, subsystem, name, seconds):
+    """Record a duration in a histogram."""
+    key = (subsystem, name)
+    index = bisect.bisect_left(self.BOUNDS, seconds)
+    with self.__lock:
+      histogram = self.__histograms.get(key)
+      if histogram is None:
+        histogram = self.__histograms[key] = [[0] * (len(self.BOUNDS) + 1), 0, 0.0, 0.0]
+      histogram[0][index] += 1
+      histogram[1] += 1
+      histogram[2] += seconds
+      histogram[3] = max(histogram[3], seconds)
+
+  @contextmanager
+  def timer(self, subsystem, name):
+    """Record how long the with block takes in a histogram."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(subsystem, name, time.perf_counter() - start)
+
+  def snapshot(self):
+    """Return {subsystem: {name: value}}, with quantile estimates for the histograms."""
+    with self.__lock:
+      counters = dict(self.__counters)
+      histograms = {key: [list(h[0])] + h[1:] for key, h in self.__histograms.items()}
+
+    res = {'uptime': round(time.monotonic() - self.__started, 3)}
+    for (subsystem, name), value in counters.items():
+      res.setdefault(subsystem, {})[name] = value
+    for (subsystem, name), (buckets, count, total, top) in histograms.items():
+      res.setdefault(subsystem, {})[name] = {
+        'count': count,
+        'avg': total / count,
+        'p50': self.__quantile(buckets, count, top, 0.5),
+        'p99': self.__quantile(buckets, count, top, 0.99),
+        'max': top,
+      }
+    return res
+
+  def prometheus(self):
+    """Render the metrics in the Prometheus text exposition format."""
+    with self.__lock:
+      counters = sorted(self.__counters.items())
+      histograms = sorted((key, [list(h[0])] + h[1:]) for key, h in self.__histograms.items())
+
+    lines = ['# TYPE qhal_uptime_seconds gauge',
+             f'qhal_uptime_seconds {time.monotonic() - self.__started:.3f}']
+    for (subsystem, name), value in counters:
+      metric = f'qhal_{subsystem}_{name}_total'
+      lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+    for (subsystem, name), (buckets, count, total, _) in histograms:
+      metric = f'qhal_{subsystem}_{name}_seconds'
+      lines.append(f'# TYPE {metric} histogram')
+      cumulative = 0
+      for bound, n in zip(self.BOUNDS + (float('inf'),), buckets):
+        cumulative += n
+        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+        lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+      lines += [f'{metric}_sum {total:.6f}', f'{metric}_count {count}']
+    return '\n'.join(lines) + '\n'
+
+  def write_textfile(self, directory):
+    """Atomically (re)write qhal.prom in directory, for the textfile collector."""
+    filename = os.path.join(directory, 'qhal.prom')
+    tmp_file = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as file:
+      file.write(self.prometheus())
+    os.replace(tmp_file, filename)
+
+  def __quantile(self, buckets, count, top, q):
+    # Upper bound of the bucket holding the quantile, the max past the last one
+    cumulative = 0
+    for bound, n in zip(self.BOUNDS, buckets):
+      cumulative += n
+      if cumulative >= q * count:
+        return min(bound, top)
+    return top
+
+
+metrics = Metrics()
+
+
+class RealBackend:
+  """The QNAP hardware: port I/O, the LCD serial port and hwmon in sysfs."""
+
+  hwmon_root = HWMON_ROOT
+  hwmon_cache = HWMON_CACHE
+
+  def ioperm(self, port, count, enable):
+    """Get or release access to count I/O ports. Returns 0 on success."""
+    from portio import ioperm
+    return ioperm(port, count, enable)
+
+  def ports(self):
+    """Return the (inb, outb) functions."""
+    from portio import inb, outb
+    return inb, outb
+
+  def serial(self, port, baudrate, timeout):
+    """Open a serial port."""
+    from serial import Serial
+    return Serial(port=port, baudrate=baudrate, timeout=timeout)
+
+  def command(self, args):
+    """Command."""
+    return 'Not running on the simulator'
+
+
+def load_backend(name=BACKEND):
+  """Return the hardware backend called name."""
+  if name == 'real':
+    return RealBackend()
+  elif name == 'sim':
+    import qhalsim
+    return qhalsim.SimBackend(hardware.leds, hardware.buttons, hardware.sensors)
+  raise ValueError(f'Unknown backend: {name}')
+
+
+class Timer:
+  """Handle on a callback scheduled by the EventLoop."""
+
+  def __init__(self, deadline, period, callback, args):
+    """Init."""
+    self.deadline = deadline
+    self.period = period
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    """Prevent any further execution of the callback."""
+    self.cancelled = True
+
+
+class EventLoop:
+  """Single threaded loop multiplexing file descriptors and timers.
+
+  The loop sleeps until either a registered file descriptor becomes ready or
+  the next timer is due. Other threads can hand work back to the loop through
+  call_soon_threadsafe(), which wakes it up through a self-pipe.
+  """
+
+  def __init__(self, logger):
+    """Init."""
+    self.__log = logger
+    self.__selector = selectors.DefaultSelector()
+    self.__timers = []
+    self.__sequence = itertools.count()
+    self.__pending = deque()
+    self.__lock = threading.Lock()
+    self.__running = False
+
+    self.__wakeup_r, self.__wakeup_w = os.pipe()
+    os.set_blocking(self.__wakeup_r, False)
+    os.set_blocking(self.__wakeup_w, False)
+    self.__selector.register(self.__wakeup_r, selectors.EVENT_READ, self.__drain_wakeup)
+
+  def register(self, fileobj, events, callback):
+    """Call callback(fileobj, mask) whenever fileobj is ready for events."""
+    self.__selector.register(fileobj, events, callback)
+
+  def modify(self, fileobj, events, callback):
+    """Change the events or callback associated with fileobj."""
+    self.__selector.modify(fileobj, events, callback)
+
+  def unregister(self, fileobj):
+    """Stop monitoring fileobj."""
+    self.__selector.unregister(fileobj)
+
+  def call_later(self, delay, callback, *args):
+    """Run callback once, after delay seconds."""
+    return self.__schedule(Timer(time.monotonic() + delay, None, callback, args))
+
+  def call_every(self, period, callback, *args):
+    """Run callback every period seconds, starting one period from now."""
+    return self.__schedule(Timer(time.monotonic() + period, period, callback, args))
+
+  def call_soon_threadsafe(self, callback, *args):
+    """Run callback on the loop thread. Safe to call from any thread."""
+    with self.__lock:
+      self.__pending.append((callback, args))
+    try:
+      os.write(self.__wakeup_w, b'\0')
+    except BlockingIOError:
+      pass  # The loop already has a wake-up pending
+
+  def stop(self):
+    """Ask the loop to exit after the current iteration."""
+    self.__running = False
+    try:
+      os.write(self.__wakeup_w, b'\0')
+    except BlockingIOError:
+      pass
+
+  def run(self):
+    """Run until stop() is called."""
+    self.__running = True
+    while self.__running:
+      for key, mask in self.__selector.select(self.__next_timeout()):
+        self.__invoke(key.data, key.fileobj, mask)
+      self.__run_pending()
+      self.__run_timers()
+
+  def close(self):
+    """Release the resources held by the loop."""
+    self.__selector.close()
+    os.close(self.__wakeup_r)
+    os.close(self.__wakeup_w)
+
+  def __schedule(self, timer):
+    heapq.heappush(self.__timers, (timer.deadline, next(self.__sequence), timer))
+    return timer
+
+  def __next_timeout(self):
+    while self.__timers and self.__timers[0][2].cancelled:
+      heapq.heappop(self.__timers)
+    if self.__pending:
+      return 0
+    if not self.__timers:
+      return None
+    return max(0, self.__timers[0][0] - time.monotonic())
+
+  def __drain_wakeup(self, fileobj, mask):
+    try:
+      while os.read(self.__wakeup_r, 4096):
+        pass
+    except BlockingIOError:
+      pass
+
+  def __run_pending(self):
+    with self.__lock:
+      pending, self.__pending = self.__pending, deque()
+    for callback, args in pending:
+      self.__invoke(callback, *args)
+
+  def __run_timers(self):
+    now = time.monotonic()
+    while self.__timers and self.__timers[0][0] <= now:
+      _, _, timer = heapq.heappop(self.__timers)
+      if timer.cancelled:
+        continue
+      metrics.observe('loop', 'timer_lateness', now - timer.deadline)
+      if timer.period is not None:
+        # Keep a steady cadence, but never try to catch up on missed periods
+        timer.deadline += timer.period
+        if timer.deadline <= now:
+          timer.deadline = now + timer.period
+        self.__schedule(timer)
+      self.__invoke(timer.callback, *timer.args)
+
+  def __invoke(self, callback, *args):
+    start = time.perf_counter()
+    try:
+      callback(*args)
+    except Exception as e:
+      self.__log.error(f'Unhandled exception in loop callback {callback}', exc_info=e)
+    metrics.observe('loop', 'callback', time.perf_counter() - start)
+
+
+class ClientConnection:
+  """State of a client connected to the daemon socket."""
+
+  def __init__(self, sock):
+    """Init."""
+    self.sock = sock
+    self.inbox = bytearray()
+    self.outbox = bytearray()
+    self.events = selectors.EVENT_READ
+    self.subscription = None
+
+  def requests(self):
+    """Extract the complete request lines received so far."""
+    lines = self.inbox.split(b'\n')
+    self.inbox = bytearray(lines.pop())
+    if len(self.inbox) > MAX_REQUEST_SIZE:
+      raise ValueError(f'Request exceeds {MAX_REQUEST_SIZE} bytes')
+    return [line for line in lines if line.strip()]
+
+
+class Subscription:
+  """Events a client subscribed to: every event of some kinds, or those of some names.
+
+  Filters are either a kind, or a kind and a name such as 'led:Status_Red'.
+  No filter at all means every event.
+  """
+
+  USAGE = f"Usage: subscribe [<{'|'.join(EVENT_KINDS)}>[:<name>] ...]"
+
+  def __init__(self, filters):
+    """Init. Raises ValueError on an invalid filter."""
+    # {kind: set of names, or None for all of them}
+    self.__kinds = {} if filters else {kind: None for kind in EVENT_KINDS}
+    for spec in filters:
+      kind, _, name = spec.partition(':')
+      if kind not in EVENT_KINDS:
+        raise ValueError(f'Unknown event kind: {kind}. {self.USAGE}')
+      if not name:
+        self.__kinds[kind] = None
+      elif kind not in self.__kinds or self.__kinds[kind] is not None:
+        self.__kinds.setdefault(kind, set()).add(name)
+
+  def matches(self, kind, name):
+    """Whether the event is wanted."""
+    if kind not in self.__kinds:
+      return False
+    names = self.__kinds[kind]
+    return names is None or name in names
+
+  def __str__(self):
+    """Return the filters, the way they are given."""
+    return ' '.join(kind if names is None else ' '.join(f'{kind}:{name}' for name in sorted(names))
+                    for kind, names in self.__kinds.items())
+
 
 class QhalDaemon:
   """Daemon running in the background to handle Hardware I/O."""
 
   def __init__(self):
     """Init."""
-    self.__log_config = LoggerConfig(name=f"{Path(__file__).stem}_daemon")
+    self.__log_config = LoggerConfig(name=f"{Path(__file__).stem}_daemon", background=True)
     self.__log = self.__log_config.get_logger()
-    self.__btnHandler = ButtonHandler(self.__log)
-    self.__ledHandler = LedHandler(self.__log)
-
+    self.__loop = EventLoop(self.__log)
+    self.__backend = load_backend()
+    self.__superio = SuperIO(self.__log, self.__backend)
+    self.__buzzer = BuzzerWorker(self.__log)
+    self.__jobs = JobRunner(self.__log, publish=self.__publish_threadsafe)
+    self.__btnHandler = ButtonHandler(self.__log, self.__superio, self.__buzzer, self.__jobs,
+                                      publish=self.__publish)
+    self.__ledHandler = LedHandler(self.__log, self.__superio, publish=self.__publish)
+    self.__lcd = LcdHandler(self.__log, self.__backend)
+    hwmon = HwmonReader(self.__log, self.__backend.hwmon_root, self.__backend.hwmon_cache)
+    self.__sampler = SensorSampler(self.__log, hwmon, hardware.sensors, publish=self.__publish)
+    try:
+      self.__fans = FanController(self.__log, hwmon, self.__sampler, load_fan_config(),
+                                  self.__sampler.period)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+      self.__log.error('Invalid fan control configuration, fans are left alone', exc_info=e)
+      self.__fans = FanController(self.__log, hwmon, self.__sampler, {})
+    try:
+      self.__alerts = AlertEngine(self.__log, load_alert_config(), self.__ledHandler,
+                                  self.__buzzer, self.__lcd, publish=self.__publish)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      self.__log.error('Invalid alert configuration, alerts are disabled', exc_info=e)
+      self.__alerts = AlertEngine(self.__log, [], self.__ledHandler, self.__buzzer, self.__lcd)
+    self.__ups = UpsHandler(self.__log, self.__ledHandler, self.__buzzer, self.__lcd,
+                            self.__call_later, publish=self.__publish)
+    self.__raid = RaidMonitor(self.__log, self.__ledHandler, publish=self.__publish)
+    self.__disks = DiskActivity(self.__log, self.__ledHandler)
+    self.__smart = SmartCache(self.__log)
+
+    self.__clients = {}
+    self.__subscribers = []
     self.__test_mode = False
+    self.__led_timer = None
+    self.__pattern_timer = None
 
     # Set up signal handlers
     signal.signal(signal.SIGTERM, self.__handle_signal)
@@ -100,52 +620,241 @@ class QhalDaemon:
 
   def __handle_signal(self, signum, frame):
     self.__log.info(f"Received signal {signum}, stopping daemon...")
-    self.__running = False
+    self.__loop.stop()
 
-  def handle_command(self, command):
+  def handle_command(self, cmd, args):
     """Handle."""
-    parts = command.split()
-    cmd = parts[0]
-    args = parts[1:]
-
     if cmd == 'led':
-      return self.__ledHandler.command(args)
+      res = self.__ledHandler.command(args)
+      self.__arm_led_patterns()
+      return res
     elif cmd == 'button':
       return self.__btnHandler.command(args)
+    elif cmd == 'sensor':
+      return self.__sampler.command(args)
+    elif cmd == 'beep':
+      return self.__buzzer.command(args)
+    elif cmd == 'jobs':
+      return self.__jobs.command(args)
+    elif cmd == 'lcd':
+      return self.__lcd.command(args)
+    elif cmd == 'fanctl':
+      return self.__fans.command(args)
+    elif cmd == 'alerts':
+      return self.__alerts.command(args)
+    elif cmd == 'ups':
+      return self.__ups.command(args)
+    elif cmd == 'raid':
+      return self.__raid.command(args)
+    elif cmd == 'smart':
+      return self.__smart.command(args)
+    elif cmd == 'stats':
+      return metrics.snapshot() if not args else 'Usage: stats'
+    elif cmd == 'sim':
+      return self.__backend.command(args)
     elif cmd == 'test':
       if len(args) != 1:
         return 'Usage: test <on|off>'
       if args[0] == 'on':
-        self.__test_mode = True
+        self.__set_test_mode(True)
         return 'Test mode enabled'
       elif args[0] == 'off':
-        self.__test_mode = False
+        self.__set_test_mode(False)
         return 'Test mode disabled'
       else:
         return 'Usage: test <on|off>'
     else:
       return f'Unknown command: {cmd}'
 
-  def __job(self, server_socket):
-    """Job."""
+  def __set_test_mode(self, enabled):
+    self.__test_mode = enabled
+    if enabled and self.__led_timer is None:
+      # LEDs only need a periodic tick to animate the test pattern
+      self.__led_timer = self.__loop.call_every(LED_PERIOD, self.__led_tick)
+    elif not enabled and self.__led_timer is not None:
+      self.__led_timer.cancel()
+      self.__led_timer = None
+      # Let the handler restore the LEDs to their previous state
+      self.__led_tick()
+
+  def __arm_led_patterns(self):
+    # The pattern timer only runs while some LED is playing a pattern
+    if self.__ledHandler.animating and self.__pattern_timer is None:
+      self.__pattern_timer = self.__loop.call_every(LED_TICK, self.__pattern_tick)
+    elif not self.__ledHandler.animating and self.__pattern_timer is not None:
+      self.__pattern_timer.cancel()
+      self.__pattern_timer = None
+
+  def __call_later(self, delay, callback, *args):
+    # For callbacks of the handlers, which may start LED patterns
+    return self.__loop.call_later(delay, self.__led_callback, callback, *args)
+
+  def __led_callback(self, callback, *args):
+    callback(*args)
+    self.__arm_led_patterns()
+
+  def __pattern_tick(self):
+    # The test pattern owns the LEDs while it runs
+    if not self.__test_mode:
+      with metrics.timer('leds', 'pattern_tick'):
+        self.__ledHandler.animate()
+    self.__arm_led_patterns()
+
+  def __sensor_tick(self):
+    samples = self.__sampler.sample()
+    self.__fans.update()
+    self.__alerts.feed(samples, time.time())
+    self.__arm_led_patterns()
+
+  def __write_textfile(self):
     try:
-      conn, _ = server_socket.accept()
-      with conn:
-        data = conn.recv(1024)
-        if data:
-          try:
-            response = self.handle_command(data.decode())
-            conn.sendall(response.encode())
-          except NotImplementedError as e:
-            conn.sendall(f'Command not yet implemented: {e}'.encode())
-          except Exception as e:
-            self.__log.critical('Failed to handle command', exc_info=e)
-            conn.sendall(f'Could not process command: {data.decode()}'.encode())
-    except socket.timeout:
-      # Run background tasks periodically
+      metrics.write_textfile(TEXTFILE_DIR)
+    except OSError as e:
+      self.__log.error(f'Failed to write the metrics to {TEXTFILE_DIR}', exc_info=e)
+
+  def __button_tick(self):
+    with metrics.timer('buttons', 'tick'), self.__superio:
       self.__btnHandler.run(self.__test_mode)
+
+  def __led_tick(self):
+    with self.__superio:
       self.__ledHandler.run(self.__test_mode)
 
+  def __disk_tick(self):
+    # The test pattern owns the LEDs while it runs
+    if not self.__test_mode:
+      with metrics.timer('disks', 'tick'), self.__superio:
+        self.__disks.tick()
+
+  def __accept(self, server_socket, mask):
+    try:
+      conn, _ = server_socket.accept()
+    except BlockingIOError:
+      return
+    conn.setblocking(False)
+    metrics.count('ipc', 'connections')
+    self.__loop.register(conn, selectors.EVENT_READ, self.__on_client)
+    self.__clients[conn] = ClientConnection(conn)
+
+  def __on_client(self, conn, mask):
+    client = self.__clients[conn]
+    if mask & selectors.EVENT_READ:
+      try:
+        data = conn.recv(4096)
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError:
+        data = b''
+      if not data:
+        self.__close_client(client)
+        return
+      client.inbox += data
+      try:
+        lines = client.requests()
+      except ValueError as e:
+        self.__log.error(f'Dropping client: {e}')
+        self.__close_client(client)
+        return
+      for line in lines:
+        client.outbox += json.dumps(self.__job(line, client)).encode() + b'\n'
+      if conn not in self.__clients:
+        # A slow subscriber dropped while publishing the events of its commands
+        return
+    if mask & selectors.EVENT_WRITE and client.outbox:
+      try:
+        sent = conn.send(client.outbox)
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError:
+        self.__close_client(client)
+        return
+      del client.outbox[:sent]
+    self.__watch(client)
+
+  def __watch(self, client):
+    # Only wait for the socket to be writable while there is something to send
+    events = selectors.EVENT_READ
+    if client.outbox:
+      events |= selectors.EVENT_WRITE
+    if events != client.events:
+      client.events = events
+      self.__loop.modify(client.sock, events, self.__on_client)
+
+  def __close_client(self, client):
+    self.__loop.unregister(client.sock)
+    del self.__clients[client.sock]
+    if client.subscription is not None:
+      self.__subscribers.remove(client)
+    client.sock.close()
+
+  def __subscribe(self, client, args):
+    if args == ['off']:
+      if client.subscription is not None:
+        client.subscription = None
+        self.__subscribers.remove(client)
+      return 'Unsubscribed'
+    subscription = Subscription(args)
+    if client.subscription is None:
+      self.__subscribers.append(client)
+    client.subscription = subscription
+    self.__log.info(f'Client subscribed to: {subscription}')
+    return f'Subscribed to: {subscription}'
+
+  def __publish(self, kind, name, data):
+    # Events are encoded once, then queued to every subscriber wanting them.
+    # A subscriber whose backlog exceeds SUBSCRIBER_BUFFER is disconnected,
+    # rather than letting the daemon buffer without bound.
+    line = None
+    for client in list(self.__subscribers):
+      if not client.subscription.matches(kind, name):
+        continue
+      if line is None:
+        line = json.dumps(dict(data, event=kind, name=name, time=time.time())).encode() + b'\n'
+      if len(client.outbox) + len(line) > SUBSCRIBER_BUFFER:
+        self.__log.warning(f'Dropping subscriber:'
+                           f' over {SUBSCRIBER_BUFFER} bytes of events pending')
+        metrics.count('events', 'dropped_subscribers')
+        self.__close_client(client)
+        continue
+      client.outbox += line
+      metrics.count('events', 'sent')
+      self.__watch(client)
+
+  def __publish_threadsafe(self, kind, name, data):
+    if self.__subscribers:
+      self.__loop.call_soon_threadsafe(self.__publish, kind, name, data)
+
+  def __job(self, line, client):
+    """Job."""
+    try:
+      request = json.loads(line.decode())
+      req_id = request.get('id')
+      cmd = request['cmd']
+      args = [str(arg) for arg in request.get('args', [])]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+      self.__log.error(f'Malformed request: {line}', exc_info=e)
+      metrics.count('ipc', 'malformed')
+      return {'id': None, 'ok': False, 'error': 'Malformed request'}
+
+    metrics.count('ipc', 'requests')
+    if cmd == 'subscribe':
+      # Subscriptions belong to the connection, not to the daemon
+      try:
+        return {'id': req_id, 'ok': True, 'result': self.__subscribe(client, args)}
+      except ValueError as e:
+        return {'id': req_id, 'ok': False, 'error': str(e)}
+    try:
+      with metrics.timer('ipc', 'command'):
+        return {'id': req_id, 'ok': True, 'result': self.handle_command(cmd, args)}
+    except NotImplementedError as e:
+      metrics.count('ipc', 'errors')
+      return {'id': req_id, 'ok': False, 'error': f'Command not yet implemented: {e}'}
+    except Exception as e:
+      self.__log.critical('Failed to handle command', exc_info=e)
+      metrics.count('ipc', 'errors')
+      return {'id': req_id, 'ok': False,
+              'error': f"Could not process command: {' '.join([cmd] + args)}"}
+
   def run(self):
     """Run."""
     self.__log.info('== Daemon Started ==')
@@ -153,78 +862,249 @@ class QhalDaemon:
       if os.path.exists(SOCKET_PATH):
         os.remove(SOCKET_PATH)
 
-      status = ioperm(IO_REG_PORT, IO_REG_COUNT, 1)
+      status = self.__backend.ioperm(IO_REG_PORT, IO_REG_COUNT, 1)
       if status:
         raise Exception('Failed to get I/O permissions')
 
       with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_socket:
         server_socket.bind(SOCKET_PATH)
         server_socket.listen()
-        server_socket.settimeout(SOCKET_TIMEOUT)
-
-        self.__running = True
-        while self.__running:
-          self.__job(server_socket)
+        server_socket.setblocking(False)
+
+        self.__loop.register(server_socket, selectors.EVENT_READ, self.__accept)
+        self.__loop.call_every(BUTTON_PERIOD, self.__button_tick)
+        self.__buzzer.start()
+        self.__raid.start(self.__loop.call_soon_threadsafe)
+        if DISK_ACTIVITY_PERIOD > 0 and self.__disks.start():
+          self.__loop.call_every(DISK_ACTIVITY_PERIOD, self.__disk_tick)
+        self.__smart.start()
+        self.__smart.refresh()
+        self.__loop.call_every(SMART_PERIOD, self.__smart.refresh)
+        self.__sensor_tick()
+        if FAN_CONTROL:
+          self.__fans.command(['on'])
+        self.__loop.call_every(self.__sampler.period, self.__sensor_tick)
+        if TEXTFILE_DIR:
+          self.__loop.call_every(TEXTFILE_PERIOD, self.__write_textfile)
+        self.__loop.run()
+
+        for client in list(self.__clients.values()):
+          self.__close_client(client)
+        self.__loop.unregister(server_socket)
+        self.__buzzer.stop()
+        self.__raid.stop()
+        self.__disks.stop()
+        self.__smart.stop()
+        self.__lcd.close()
+        self.__fans.give_back()
 
       # Clean-up logic here
       if self.__test_mode:
-        self.__test_mode = False
         # We need to restore the LEDs to their previous state before exiting
-        self.__ledHandler.run(self.__test_mode)
+        self.__set_test_mode(False)
 
       self.__log.info('== Daemon Exited gracefully ==')
+      self.__log_config.close()
       os._exit(0)
     except Exception as e:
       self.__log.critical('Daemon failed', exc_info=e)
     finally:
-      status = ioperm(IO_REG_PORT, IO_REG_COUNT, 0)
+      status = self.__backend.ioperm(IO_REG_PORT, IO_REG_COUNT, 0)
       if status:
         self.__log.error('Failed to release I/O permissions')
+      self.__log_config.close()
+
+
+class SuperIO:
+  """Shadow copy of the SuperIO registers, reached through the index/data ports.
+
+  Within a transaction, each register is read from the chip at most once and
+  bit changes are only staged. When the outermost transaction ends, every
+  modified register is written back with a single write.
+  """
+
+  def __init__(self, logger, backend):
+    """Init."""
+    self.__inb, self.__outb = backend.ports()
+    self.__log = logger
+    # Checked once, so that disabled debug messages cost nothing on the hot path
+    self.__debug = logger.isEnabledFor(logging.DEBUG)
+    self.__depth = 0
+    self.__shadow = {}
+    self.__pending = {}
+
+  def __enter__(self):
+    """Open a transaction."""
+    self.__depth += 1
+    return self
+
+  def __exit__(self, *_):
+    """Close a transaction, flushing the staged writes if it is the outermost one."""
+    self.__depth -= 1
+    if self.__depth == 0:
+      try:
+        self.flush()
+      finally:
+        # Registers may change behind our back between transactions
+        self.__shadow.clear()
+        self.__pending.clear()
+
+  def read(self, port):
+    """Read a register, including the bit changes staged for it."""
+    if port not in self.__shadow:
+      self.__outb(port, IO_REG_PORT)
+      self.__shadow[port] = self.__inb(IO_REG_DATA)
+      metrics.count('port', 'reads')
+    val = self.__shadow[port]
+    if port in self.__pending:
+      mask, bits = self.__pending[port]
+      val = (val & ~mask) | bits
+    return val
+
+  def stage(self, port, mask, bits):
+    """Stage new values for the bits of a register selected by mask."""
+    old_mask, old_bits = self.__pending.get(port, (0, 0))
+    self.__pending[port] = (old_mask | mask, (old_bits & ~mask) | (bits & mask))
+
+  def flush(self):
+    """Write every register with staged changes, once."""
+    for port in list(self.__pending):
+      val = self.read(port)
+      del self.__pending[port]
+      if val != self.__shadow[port]:
+        if self.__debug:
+          self.__log.debug('Writing %#x to register %#x', val, port)
+        self.__outb(port, IO_REG_PORT)
+        self.__outb(val, IO_REG_DATA)
+        metrics.count('port', 'writes')
+        self.__shadow[port] = val
 
 
 class IOHandler:
   """Absstraction for Digital I/O operations."""
 
-  def __init__(self, logger):
+  def __init__(self, logger, superio):
     """Init."""
     self._log = logger
+    self._debug = logger.isEnabledFor(logging.DEBUG)
+    self._superio = superio
 
   def read_io(self, io, with_logs=True):
     """Read I/O."""
-    outb(io.port, IO_REG_PORT)
-    val = inb(IO_REG_DATA)
-    if with_logs:
-      self._log.debug(f'Raw value read for {io.name} value: {hex(val)}')
-    val = 1 if val & (1 << io.bit) else 0
-    if with_logs:
-      self._log.debug(f'Bit for {io.name}: {val}. Returning the opposite')
-    return 0 if val else 1
+    return self.read_many([io], with_logs=with_logs)[io]
 
   def write_io(self, io, value, with_logs=True):
     """Write I/O."""
-    outb(io.port, IO_REG_PORT)
-    pre_val = inb(IO_REG_DATA)
-    if with_logs:
-      self._log.debug(f'Raw value read for {io.name} value: {hex(pre_val)}')
-    val = 0 if value else 1
-    mask = 1 << io.bit
-    post_val = (pre_val & ~mask) | (val << io.bit)
-    if with_logs:
-      self._log.debug(f'Writing {hex(post_val)} ({val}) to {io.name} for bit {io.bit}')
-    outb(post_val, IO_REG_DATA)
+    self.set_many([(io, value)], with_logs=with_logs)
+
+  def read_many(self, ios, with_logs=True):
+    """Read many I/Os, reading each distinct register once. Returns {io: value}."""
+    return self.read_groups(HardwareMap.group(ios), with_logs=with_logs)
+
+  def read_groups(self, groups, with_logs=True):
+    """Read I/Os grouped per register, as compiled by HardwareMap. Returns {io: value}."""
+    res = {}
+    with self._superio as superio:
+      for port, members in groups:
+        val = superio.read(port)
+        for pin, mask in members:
+          if with_logs and self._debug:
+            self._log.debug('Raw value read for %s value: %#x', pin.name, val)
+            self._log.debug('Bit for %s: %d. Returning the opposite', pin.name, bool(val & mask))
+          res[pin] = 0 if val & mask else 1
+    return res
+
+  def set_many(self, values, with_logs=True):
+    """Write many (io, value) pairs, with a single write per distinct register."""
+    staged = {}
+    for pin, value in values:
+      val = 0 if value else 1
+      if with_logs and self._debug:
+        self._log.debug('Staging (%d) to %s for bit %d', val, pin.name, pin.bit)
+      mask, bits = staged.get(pin.port, (0, 0))
+      staged[pin.port] = (mask | 1 << pin.bit, bits | val << pin.bit)
+    with self._superio as superio:
+      for port, (mask, bits) in staged.items():
+        superio.stage(port, mask, bits)
+
+
+class GestureDetector:
+  """Debounces the samples of one button and turns them into gestures.
+
+  The level must be stable for BUTTON_DEBOUNCE seconds before an edge is
+  accepted. On release, a press held for BUTTON_LONG_PRESS seconds or more is
+  a 'long' press. Otherwise it is a 'short' press, unless double presses are
+  expected: the detector then waits up to BUTTON_DOUBLE_PRESS seconds for a
+  second press before settling.
+  """
+
+  def __init__(self, debounce, long_press, double_press):
+    """Init."""
+    self.__debounce = debounce
+    self.__long_press = long_press
+    self.__double_press = double_press
+    self.level = None
+    self.__raw = None
+    self.__raw_since = 0.0
+    self.__pressed_at = None
+    self.__short_at = None
+
+  def sample(self, raw, now, wait_for_double):
+    """Feed a sample. Returns (edge, gesture), each of them possibly None."""
+    if raw != self.__raw:
+      self.__raw = raw
+      self.__raw_since = now
+
+    edge = None
+    gesture = None
+    if self.level is None:
+      # First sample is taken as is, whatever the state of the button
+      self.level = raw
+    elif raw != self.level and now - self.__raw_since >= self.__debounce:
+      self.level = raw
+      edge = 'pressed' if raw else 'released'
+      if raw:
+        self.__pressed_at = now
+      elif self.__pressed_at is not None:
+        held = now - self.__pressed_at
+        self.__pressed_at = None
+        if held >= self.__long_press:
+          self.__short_at = None
+          gesture = 'long'
+        elif self.__short_at is not None:
+          self.__short_at = None
+          gesture = 'double'
+        elif wait_for_double:
+          self.__short_at = now
+        else:
+          gesture = 'short'
+
+    if gesture is None and self.__short_at is not None and self.__pressed_at is None \
+       and now - self.__short_at > self.__double_press:
+      self.__short_at = None
+      gesture = 'short'
+    return edge, gesture
 
 
 class ButtonHandler(IOHandler):
   """Button Handler."""
 
-  def __init__(self, logger):
+  GESTURES = ('short', 'long', 'double')
+
+  def __init__(self, logger, superio, buzzer, jobs, publish=None):
     """Init."""
-    super().__init__(logger)
+    super().__init__(logger, superio)
+    self.__buzzer = buzzer
+    self.__jobs = jobs
+    self.__publish = publish
 
     # Construct a dictionnary of buttons,
-    # where the value is the command to execute
-    self.__commands = {button: None for button in buttons}
-    self.__prev_state = {button: None for button in buttons}
+    # where the value is the command to execute for each gesture
+    self.__commands = {button: {gesture: None for gesture in self.GESTURES}
+                       for button in buttons}
+    self.__detectors = {button: GestureDetector(BUTTON_DEBOUNCE, BUTTON_LONG_PRESS,
+                                                BUTTON_DOUBLE_PRESS)
+                        for button in buttons}
 
   def get_button(self, button):
     """Get Button."""
@@ -233,90 +1113,200 @@ class ButtonHandler(IOHandler):
 
   def command(self, args):
     """Command."""
+    usage = f"Usage: button <name> [{'|'.join(self.GESTURES)}] -- <to_execute>"
     if len(args) < 1:
       self._log.error(f'Invalid number of arguments: {args}')
-      return 'Usage: button <name> -- <to_execute>'
-    if args[0] not in [btn.name for btn in buttons]:
+      return usage
+    button = hardware.button.get(args[0])
+    if button is None:
       self._log.error(f'Unknown button: {args[0]}')
       return f'Unknown button: {args[0]}'
 
-    button = next((b for b in buttons if b.name == args[0]), None)
-
-    if len(args) < 2:
-      self._log.error('Expected at least an empty list of arguments for the command')
-      return f'Unexpected error while configuring button {button.name}'
-
-    # Parse the remaining arguments from an array with square brackets
-    to_execute = ast.literal_eval(' '.join(args[1:]))
+    # An optional gesture, then the command line, optionally after a '--'
+    to_execute = args[1:]
+    gesture = 'short'
+    if to_execute and to_execute[0] in self.GESTURES:
+      gesture = to_execute[0]
+      to_execute = to_execute[1:]
+    if to_execute and to_execute[0] == '--':
+      to_execute = to_execute[1:]
     if len(to_execute) == 0:
       # We are disabling the previous command, if any
-      self.__commands[button] = None
-      self._log.info(f'Button {button.name} command disabled')
-      return f'Button {button.name} command disabled'
+      self.__commands[button][gesture] = None
+      self._log.info(f'Button {button.name} {gesture} press command disabled')
+      return f'Button {button.name} {gesture} press command disabled'
     else:
-      before = self.__commands[button]
-      self.__commands[button] = to_execute
-      self._log.info(f'Button {button.name} set to execute: {self.__commands[button]}.'
+      before = self.__commands[button][gesture]
+      self.__commands[button][gesture] = to_execute
+      self._log.info(f'Button {button.name} {gesture} press set to execute: {to_execute}.'
                      f' Before: {before}')
-      return f'Button {button.name} command set to: {self.__commands[button]}'
+      return f'Button {button.name} {gesture} press command set to: {to_execute}'
 
   def __button_test(self, button):
     self._log.info(f'Button {button.name} was pressed while in test mode')
     # Do a beep
-    res = Popen([f"{os.environ['HOME_BIN']}/qhal", 'beep', 'Beep'], stdout=PIPE, stderr=PIPE)
-    stdout, stderr = res.communicate()
-    if res.returncode:
-      self._log.error(f'Beep failed with return code: {res.returncode}.'
-                      f' Stderr: {res.stderr}. Stdout: {stdout}')
-    else:
-      self._log.info(f'Beep executed with result: {res.returncode}')
-
-  def __button_execute(self, button):
-    self._log.info(f'Button {button.name} was released. Executing command:'
-                   f' {self.__commands[button]}')
-    try:
-      if self.__commands[button] is not None:
-        res = Popen(self.__commands[button], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = res.communicate()
-        self._log.info(f'Command {self.__commands[button]} executed with result: {res.returncode}')
-        if res.returncode:
-          self._log.error(f'Command failed with return code: {res.returncode}.'
-                          f'Stderr: {stderr}. Stdout: {stdout}')
+    self.__buzzer.play(hardware.sound['Beep'])
+
+  def __button_execute(self, button, gesture):
+    to_execute = self.__commands[button][gesture]
+    if to_execute is None and gesture == 'long':
+      # Holding a button used to behave like a regular press
+      to_execute = self.__commands[button]['short']
+    self._log.info(f'Button {button.name} {gesture} press. Executing command: {to_execute}')
+    try:
+      if to_execute is not None:
+        metrics.count('buttons', 'commands')
+        self.__jobs.submit(button.name, to_execute)
       else:
-        self._log.info(f'No command configured for button {button.name}')
+        self._log.info(f'No command configured for button {button.name} {gesture} press')
     except Exception as e:
       self._log.error('Failed to execute command', exc_info=e)
 
   def run(self, is_test_mode):
     """Run."""
+    try:
+      states = self.read_groups(hardware.button_groups, with_logs=False)
+    except Exception as e:
+      self._log.error('Failed to get button state', exc_info=e)
+      return
+
+    now = time.monotonic()
     for button in buttons:
       try:
-        state = self.get_button(button)
+        detector = self.__detectors[button]
+        was_initialized = detector.level is not None
+        wait_for_double = self.__commands[button]['double'] is not None
+        edge, gesture = detector.sample(states[button], now, wait_for_double)
+        if not was_initialized:
+          self._log.info(f'Button {button.name} was initialized to: {detector.level}')
+        if edge is not None:
+          self._log.info(f'Button {button.name} was {edge}')
+          metrics.count('buttons', edge)
+          if self.__publish:
+            self.__publish('button', button.name, {'edge': edge})
+        if gesture is not None and self.__publish:
+          self.__publish('button', button.name, {'gesture': gesture})
         if is_test_mode:
-          if state == 1:
+          if edge == 'pressed':
             self.__button_test(button)
-        else:
-          if self.__prev_state[button] is None:
-            self._log.info(f'Button {button.name} was initialized to: {state}')
-            self.__prev_state[button] = state
-          elif state != self.__prev_state[button]:
-            self._log.info(f'Button {button.name} changed state from'
-                           f' {self.__prev_state[button]} to {state}')
-            self.__prev_state[button] = state
-            if state == 0:
-              self.__button_execute(button)
-            else:
-              self._log.info(f'Button {button.name} was pressed')
+        elif gesture is not None:
+          self.__button_execute(button, gesture)
       except Exception as e:
         self._log.error('Failed to get button state', exc_info=e)
 
 
+LED_PATTERN = namedtuple('LED_PATTERN', ['name', 'segments', 'repeat'])
+LED_PATTERNS = ('blink', 'heartbeat', 'pulse', 'duty')
+
+
+def led_pattern(name, args):
+  """Build the named LED pattern from its command arguments.
+
+  A pattern is a list of (on, seconds) segments, played once or in a loop.
+  """
+  try:
+    values = [float(arg) for arg in args]
+  except ValueError:
+    raise ValueError(f'Invalid {name} arguments: {args}')
+  if any(not math.isfinite(value) or value <= 0 for value in values):
+    raise ValueError(f'Invalid {name} arguments: {args}')
+
+  if name == 'blink' and len(values) <= 1:
+    half = 0.5 / (values[0] if values else 1.0)
+    return LED_PATTERN(name, [(True, half), (False, half)], True)
+  elif name == 'heartbeat' and not values:
+    return LED_PATTERN(name, [(True, 0.1), (False, 0.15), (True, 0.1), (False, 0.65)], True)
+  elif name == 'pulse' and len(values) <= 1:
+    return LED_PATTERN(name, [(True, (values[0] if values else 100) / 1000)], False)
+  elif name == 'duty' and len(values) == 2 and values[1] < 100:
+    period, percent = values
+    return LED_PATTERN(name, [(True, period * percent / 100),
+                              (False, period * (100 - percent) / 100)], True)
+  raise ValueError(f'Usage: led <enum> {name} {LedHandler.PATTERN_USAGE[name]}')
+
+
+class TimerWheel:
+  """Hashed timer wheel, firing keys with a resolution of one tick.
+
+  A key is filed in the slot of the tick its deadline falls in, so advancing
+  the wheel only looks at the slots of the ticks that went by.
+  """
+
+  def __init__(self, tick, slots):
+    """Init."""
+    self.__tick = tick
+    self.__slots = [{} for _ in range(slots)]
+    self.__where = {}
+    self.__origin = time.monotonic()
+    self.__current = 0
+
+  def __len__(self):
+    """Return the number of keys scheduled."""
+    return len(self.__where)
+
+  def schedule(self, key, deadline):
+    """(Re)schedule key to fire once the monotonic deadline has passed."""
+    self.cancel(key)
+    due = max(self.__current + 1, math.ceil((deadline - self.__origin) / self.__tick))
+    slot = due % len(self.__slots)
+    self.__slots[slot][key] = due
+    self.__where[key] = slot
+
+  def cancel(self, key):
+    """Forget about key, if it is scheduled."""
+    slot = self.__where.pop(key, None)
+    if slot is not None:
+      del self.__slots[slot][key]
+
+  def advance(self, now):
+    """Return the keys whose deadline passed since the previous call."""
+    target = int((now - self.__origin) / self.__tick)
+    # Going around more than once would only visit the same slots again
+    first = max(self.__current + 1, target - len(self.__slots) + 1)
+    fired = []
+    for tick in range(first, target + 1):
+      slot = self.__slots[tick % len(self.__slots)]
+      due = [key for key, at in slot.items() if at <= target]
+      for key in due:
+        del slot[key]
+        del self.__where[key]
+      fired.extend(due)
+    self.__current = max(self.__current, target)
+    return fired
+
+
 class LedHandler(IOHandler):
-  """LED Handler."""
+  """LED Handler.
 
-  def __init__(self, logger):
+  Besides plain on/off, any LED can play a pattern. Pattern edges are kept
+  in a timer wheel and every call to animate() writes the LEDs whose edge
+  is due, in one batch.
+
+  LEDs set by a command, or playing a pattern, are claimed: what the daemon
+  drives on its own, such as the disk activity, leaves them alone until the
+  'auto' state gives them back.
+  """
+
+  PATTERN_USAGE = {
+    'blink': '[hz]',
+    'heartbeat': '',
+    'pulse': '[ms]',
+    'duty': '<period_s> <percent>',
+  }
+
+  def __init__(self, logger, superio, publish=None):
     """Init."""
-    super().__init__(logger)
+    super().__init__(logger, superio)
+    self.__publish = publish
+    # Last state written to each LED, and the last one published
+    self.__states = {}
+    self.__written = {}
+    # LEDs set on or off by a command
+    self.__claimed = set()
+
+    # {led: [pattern, segment index, deadline of the segment]}
+    self.__patterns = {}
+    self.__wheel = TimerWheel(LED_TICK, LED_WHEEL_SLOTS)
 
     # Data used for test mode only
     self.__cur_led = None
@@ -326,16 +1316,83 @@ class LedHandler(IOHandler):
 
   def set_led(self, led, state, with_logs=True):
     """Set LED."""
-    if with_logs:
-      self._log.info(f'Setting LED {led.name} to {state}')
-    if state == 'on':
-      self.write_io(led, 1, with_logs=with_logs)
-      self.__prev_state[led] = 'on'
-    elif state == 'off':
-      self.write_io(led, 0, with_logs=with_logs)
-      self.__prev_state[led] = 'off'
-    else:
-      raise ValueError(f'Invalid state: {state}')
+    self.set_leds({led: state}, with_logs=with_logs)
+
+  def set_leds(self, states, with_logs=True, publish=True):
+    """Set many LEDs from a {led: state} dict, coalescing writes per register."""
+    for led, state in states.items():
+      if state not in ('on', 'off'):
+        raise ValueError(f'Invalid state: {state}')
+      if with_logs:
+        self._log.info('Setting LED %s to %s', led.name, state)
+    self.set_many([(led, state == 'on') for led, state in states.items()],
+                  with_logs=with_logs, publish=publish)
+    self.__prev_state.update(states)
+
+  def set_many(self, values, with_logs=True, publish=True):
+    """Set many LEDs from (led, on) pairs, publishing those that change."""
+    super().set_many(values, with_logs=with_logs)
+    self.__states.update(values)
+    if self.__publish:
+      for led, on in values:
+        if not publish:
+          # The next published state is a change, whatever it is
+          self.__written.pop(led, None)
+        elif self.__written.get(led) != on:
+          self.__written[led] = on
+          self.__publish('led', led.name, {'state': 'on' if on else 'off'})
+
+  def claimed(self, led):
+    """Whether a command or a pattern owns an LED."""
+    return led in self.__claimed or led in self.__patterns
+
+  def is_on(self, led):
+    """Whether an LED was last set on, None if it was never set."""
+    return self.__states.get(led)
+
+  @property
+  def animating(self):
+    """Whether some LED is playing a pattern, and animate() must be called."""
+    return bool(self.__patterns)
+
+  def set_pattern(self, led, pattern):
+    """Start playing a pattern on an LED."""
+    self._log.info(f'Setting LED {led.name} to pattern {pattern.name}')
+    now = time.monotonic()
+    on, duration = pattern.segments[0]
+    self.__patterns[led] = [pattern, 0, now + duration]
+    self.__wheel.schedule(led, now + duration)
+    self.set_many([(led, on)], with_logs=False)
+
+  def clear_pattern(self, led):
+    """Stop the pattern of an LED, leaving it as it is."""
+    if self.__patterns.pop(led, None):
+      self.__wheel.cancel(led)
+
+  def animate(self, now=None):
+    """Write the pattern edges that are due."""
+    now = time.monotonic() if now is None else now
+    writes = []
+    for led in self.__wheel.advance(now):
+      entry = self.__patterns[led]
+      pattern, index, deadline = entry
+      index += 1
+      if index == len(pattern.segments):
+        if not pattern.repeat:
+          # One-shot patterns end with the LED off
+          del self.__patterns[led]
+          writes.append((led, False))
+          continue
+        index = 0
+      on, duration = pattern.segments[index]
+      # Keep the phase, unless we fell behind by more than a segment
+      deadline = deadline + duration if deadline + duration > now else now + duration
+      entry[1:] = [index, deadline]
+      self.__wheel.schedule(led, deadline)
+      writes.append((led, on))
+    if writes:
+      metrics.count('leds', 'pattern_edges', len(writes))
+      self.set_many(writes, with_logs=False)
 
   def get_led(self, led, with_logs=True):
     """Get LED."""
@@ -346,28 +1403,46 @@ class LedHandler(IOHandler):
 
   def command(self, args):
     """command."""
-    if len(args) > 2 or len(args) < 1:
+    if len(args) < 1:
       self._log.error(f'Invalid number of arguments: {args}')
-      return 'Usage: led <enum> <on|off>'
+      return f"Usage: led <enum> <on|off|auto|{'|'.join(LED_PATTERNS)}> [args]"
 
-    if args[0] not in [led.name for led in leds]:
+    led = hardware.led.get(args[0])
+    if led is None:
       self._log.error(f'Unknown LED: {args[0]}')
       return f'Unknown LED: {args[0]}'
-
-    led = next((led for led in leds if led.name == args[0]), None)
     if len(args) == 1:
       try:
         state = self.get_led(led)
+        if led in self.__patterns:
+          return f'LED {led.name} is {state} ({self.__patterns[led][0].name})'
         return f'LED {led.name} is {state}'
       except Exception as e:
         self._log.error('Failed to get LED state', exc_info=e)
         return f'Failure to get LED state: {e.message}'
+    elif args[1] in LED_PATTERNS:
+      try:
+        pattern = led_pattern(args[1], args[2:])
+      except ValueError as e:
+        return str(e)
+      try:
+        self.set_pattern(led, pattern)
+        return f'Ok. LED {led.name} is now playing {pattern.name}'
+      except Exception as e:
+        self._log.error('Failed to set LED pattern', exc_info=e)
+        return f'Failure to set LED pattern: {e}'
     else:
       state = args[1]
-      if state not in ['on', 'off']:
+      if state not in ['on', 'off', 'auto'] or len(args) > 2:
         return f'Unknown state: {state}'
+      if state == 'auto':
+        self.clear_pattern(led)
+        self.__claimed.discard(led)
+        return f'Ok. LED {led.name} is now driven by the daemon'
       try:
+        self.clear_pattern(led)
         self.set_led(led, state)
+        self.__claimed.add(led)
         return f'Ok. LED {led.name} is now {state}'
       except Exception as e:
         self._log.error('Failed to set LED state', exc_info=e)
@@ -383,9 +1458,9 @@ class LedHandler(IOHandler):
       self.__cur_led = None
       self._log.info('LEDs entering test mode')
       # Read previous state for all leds its unkown
-      for led in leds:
-        if self.__prev_state[led] is None:
-          self.__prev_state[led] = self.get_led(led)
+      unknown = [led for led in leds if self.__prev_state[led] is None]
+      for led, val in self.read_many(unknown).items():
+        self.__prev_state[led] = 'on' if val else 'off'
       self._log.info('LEDs previous state has been saved')
     elif not is_test_mode and self.__was_in_test_mode:
       # Exiting test mode
@@ -393,8 +1468,7 @@ class LedHandler(IOHandler):
       self.__cur_led = None
       self._log.info('LEDs exiting test mode')
       # Restore previous state for all leds
-      for led in leds:
-        self.set_led(led, self.__prev_state[led])
+      self.set_leds(dict(self.__prev_state))
       self._log.info('LEDs have been restored to previous state')
 
     if is_test_mode:
@@ -414,91 +1488,1735 @@ class LedHandler(IOHandler):
       self.set_led(self.__cur_led, self.__next_state, with_logs=False)
 
 
+def play_sound(logger, sound):
+  """Play a sound on the buzzer through the QTS HAL. Blocks until it is done."""
+  res = Popen([f"{os.environ['HOME_BIN']}/qnap_hal", 'hal_app', '--se_buzzer',
+               f"enc_id=0,mode={sound.id}"], stdout=PIPE, stderr=PIPE, cwd=os.getcwd())
+  stdout, stderr = res.communicate()
+  if res.returncode:
+    logger.error(f"Failed to play sound: {sound.name}. Return Code:"
+                 f" {res.returncode}. Stderr: {stderr}. Stdout: {stdout}")
+  return res.returncode == 0
+
+
+class BuzzerWorker:
+  """Plays sounds one after the other on a background thread.
+
+  Requests return immediately. Asking for a sound that is already queued, or
+  that started playing less than BEEP_COALESCE seconds ago, is a no-op.
+  """
+
+  def __init__(self, logger, size=BEEP_QUEUE_SIZE, coalesce=BEEP_COALESCE):
+    """Init."""
+    self.__log = logger
+    self.__coalesce = coalesce
+    self.__queue = queue.Queue(maxsize=size)
+    self.__lock = threading.Lock()
+    self.__queued = set()
+    self.__started = {}
+    self.__thread = threading.Thread(target=self.__work, name='buzzer', daemon=True)
+
+  def start(self):
+    """Start the worker thread."""
+    self.__thread.start()
+
+  def stop(self, timeout=5):
+    """Stop the worker after the sound being played, dropping the queued ones."""
+    with self.__lock:
+      while True:
+        try:
+          self.__queue.get_nowait()
+        except queue.Empty:
+          break
+      self.__queued.clear()
+    self.__queue.put(None)
+    self.__thread.join(timeout)
+
+  def play(self, sound):
+    """Queue a sound. Returns a short description of what happened to the request."""
+    with self.__lock:
+      if sound in self.__queued:
+        metrics.count('beep', 'coalesced')
+        return f'Sound {sound.name} already queued'
+      started = self.__started.get(sound)
+      if started is not None and time.monotonic() - started < self.__coalesce:
+        metrics.count('beep', 'coalesced')
+        return f'Sound {sound.name} just played'
+      try:
+        self.__queue.put_nowait(sound)
+      except queue.Full:
+        self.__log.warning(f'Buzzer queue full, dropping sound {sound.name}')
+        metrics.count('beep', 'dropped')
+        return f'Buzzer busy, sound {sound.name} dropped'
+      self.__queued.add(sound)
+    return f'Sound {sound.name} queued'
+
+  def command(self, args):
+    """Command."""
+    if len(args) != 1:
+      return 'Usage: beep <sound>'
+    sound = hardware.sound.get(args[0])
+    if sound is None:
+      return f'Unknown sound: {args[0]}'
+    return self.play(sound)
+
+  def __work(self):
+    while True:
+      sound = self.__queue.get()
+      if sound is None:
+        return
+      with self.__lock:
+        self.__queued.discard(sound)
+        self.__started[sound] = time.monotonic()
+      try:
+        with metrics.timer('beep', 'play'):
+          played = play_sound(self.__log, sound)
+        if played:
+          self.__log.info(f'Played sound: {sound.name}')
+      except Exception as e:
+        self.__log.error(f'Failed to play sound: {sound.name}', exc_info=e)
+
+
+class LcdHandler:
+  """Front panel LCD, kept open by the daemon.
+
+  A framebuffer mirrors what the panel displays, so updates only send the rows
+  that changed. The panel can only be written a whole row at a time, and each
+  row costs 20 bytes, or about 170 ms at 1200 baud.
+  """
+
+  def __init__(self, logger, backend, port=LCD_PORT, baudrate=LCD_BAUDRATE):
+    """Init."""
+    self.__log = logger
+    self.__backend = backend
+    self.__port = port
+    self.__baudrate = baudrate
+    self.__serial = None
+    self.__forget()
+
+  def close(self):
+    """Close the serial port."""
+    if self.__serial is not None:
+      try:
+        self.__serial.close()
+      except Exception as e:
+        self.__log.warning(f'Failed to close {self.__port}', exc_info=e)
+      self.__serial = None
+
+  def set_backlight(self, on):
+    """Turn the backlight on or off. Returns True if a command was sent."""
+    if self.__backlight == on:
+      return False
+    self.__send(b'M^\1' if on else b'M^\0')
+    self.__backlight = on
+    return True
+
+  def write(self, lines):
+    """Display lines, sending only the rows that changed. Returns the rows sent."""
+    sent = []
+    for row, text in enumerate(lines[:LCD_ROWS]):
+      text = text.ljust(LCD_COLUMNS)[:LCD_COLUMNS]
+      if self.__rows[row] == text:
+        continue
+      self.set_backlight(True)
+      self.__send(b'M\f' + bytes([row, LCD_COLUMNS]) + text.encode('ascii', 'replace'))
+      self.__rows[row] = text
+      sent.append(row)
+    return sent
+
+  def command(self, args):
+    """Command."""
+    usage = 'Usage: lcd <on|off|write <line1> <line2>|show>'
+    if not args:
+      return usage
+    if args[0] in ('on', 'off') and len(args) == 1:
+      self.set_backlight(args[0] == 'on')
+      return f'LCD state set to: {args[0]}'
+    elif args[0] == 'write' and len(args) == 3:
+      sent = self.write(args[1:])
+      self.__log.info(f'Writing to LCD: "{args[1]}" - "{args[2]}". Rows sent: {sent}')
+      return f'LCD written: "{args[1]}" - "{args[2]}"'
+    elif args[0] == 'show' and len(args) == 1:
+      return {'backlight': self.__backlight, 'rows': self.__rows}
+    return usage
+
+  def __forget(self):
+    # Until we have written to it, we don't know what the panel shows
+    self.__rows = [None] * LCD_ROWS
+    self.__backlight = None
+
+  def __send(self, data):
+    if self.__serial is None:
+      self.__log.info(f'Opening LCD on {self.__port} at {self.__baudrate} bauds')
+      self.__serial = self.__backend.serial(self.__port, self.__baudrate, 0)
+    try:
+      with metrics.timer('lcd', 'send'):
+        self.__serial.write(data)
+      metrics.count('lcd', 'bytes', len(data))
+    except Exception:
+      self.close()
+      self.__forget()
+      raise
+
+
+class Job:
+  """A command started by the JobRunner."""
+
+  def __init__(self, job_id, group, argv):
+    """Init."""
+    self.id = job_id
+    self.group = group
+    self.argv = argv
+    self.state = 'running'
+    self.pid = None
+    self.returncode = None
+    self.started = time.time()
+    self.ended = None
+
+  def to_dict(self):
+    """Describe the job for the 'jobs' command."""
+    return {'id': self.id, 'group': self.group, 'argv': self.argv, 'state': self.state,
+            'pid': self.pid, 'returncode': self.returncode,
+            'started': self.started, 'ended': self.ended}
+
+
+class JobRunner:
+  """Runs commands concurrently with the daemon loop.
+
+  Each job is supervised by its own thread, which captures its output to the
+  log and kills it once it exceeds the timeout. Jobs are grouped (e.g. per
+  button) and each group may only have so many jobs running at once.
+  Running jobs are left alone when the daemon exits, since a button may well
+  be bound to the command shutting the machine down.
+  """
+
+  def __init__(self, logger, concurrency=JOB_CONCURRENCY, timeout=JOB_TIMEOUT,
+               history=JOB_HISTORY, publish=None):
+    """Init. publish is called from the supervising threads."""
+    self.__log = logger
+    self.__publish = publish
+    self.__concurrency = concurrency
+    self.__timeout = timeout
+    self.__lock = threading.Lock()
+    self.__ids = itertools.count(1)
+    self.__running = {}
+    self.__finished = deque(maxlen=history)
+
+  def submit(self, group, argv):
+    """Start argv in the background. Returns the Job, or None if the group is busy."""
+    with self.__lock:
+      busy = sum(1 for job in self.__running.values() if job.group == group)
+      if busy >= self.__concurrency:
+        self.__log.warning(f'{busy} job(s) already running for {group}. Ignoring: {argv}')
+        metrics.count('jobs', 'rejected')
+        return None
+      job = Job(next(self.__ids), group, list(argv))
+      self.__running[job.id] = job
+    threading.Thread(target=self.__supervise, args=(job,), name=f'job-{job.id}',
+                     daemon=True).start()
+    return job
+
+  def command(self, args):
+    """Command."""
+    if args:
+      return 'Usage: jobs'
+    with self.__lock:
+      return {'running': [job.to_dict() for job in self.__running.values()],
+              'finished': [job.to_dict() for job in self.__finished]}
+
+  def __supervise(self, job):
+    try:
+      # In its own session, so that a timeout kills the whole process tree
+      proc = Popen(job.argv, stdout=PIPE, stderr=PIPE, start_new_session=True)
+      job.pid = proc.pid
+      self.__log.info(f'Job {job.id} ({job.group}) started with PID {proc.pid}: {job.argv}')
+      try:
+        stdout, stderr = proc.communicate(timeout=self.__timeout)
+        job.state = 'done' if proc.returncode == 0 else 'failed'
+      except TimeoutExpired:
+        self.__log.error(f'Job {job.id} timed out after {self.__timeout}s. Killing it')
+        try:
+          os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+          pass
+        stdout, stderr = proc.communicate()
+        job.state = 'timeout'
+      job.returncode = proc.returncode
+      self.__log.info(f'Command {job.argv} executed with result: {proc.returncode}')
+      if proc.returncode:
+        self.__log.error(f'Command failed with return code: {proc.returncode}.'
+                         f'Stderr: {stderr}. Stdout: {stdout}')
+      else:
+        self.__log.debug(f'Job {job.id} output. Stderr: {stderr}. Stdout: {stdout}')
+    except Exception as e:
+      self.__log.error(f'Failed to execute job {job.id}: {job.argv}', exc_info=e)
+      job.state = 'failed'
+    finally:
+      job.ended = time.time()
+      metrics.count('jobs', job.state)
+      metrics.observe('jobs', 'runtime', job.ended - job.started)
+      with self.__lock:
+        del self.__running[job.id]
+        self.__finished.append(job)
+      if self.__publish:
+        self.__publish('job', job.group, job.to_dict())
+
+
+class SampleRing:
+  """Fixed-size ring buffer of (timestamp, value) samples, backed by two arrays."""
+
+  def __init__(self, capacity):
+    """Init."""
+    self.__times = array('d', [0.0]) * capacity
+    self.__values = array('d', [0.0]) * capacity
+    self.__capacity = capacity
+    self.__next = 0
+    self.__count = 0
+
+  def __len__(self):
+    """Return the number of samples."""
+    return self.__count
+
+  def append(self, timestamp, value):
+    """Add a sample, overwriting the oldest one when full."""
+    self.__times[self.__next] = timestamp
+    self.__values[self.__next] = value
+    self.__next = (self.__next + 1) % self.__capacity
+    self.__count = min(self.__count + 1, self.__capacity)
+
+  def latest(self):
+    """Return the most recent (timestamp, value), or None."""
+    if not self.__count:
+      return None
+    i = (self.__next - 1) % self.__capacity
+    return self.__times[i], self.__values[i]
+
+  def window(self, since):
+    """Return ([timestamps], [values]) for samples taken at or after since, oldest first."""
+    times, values = [], []
+    for n in range(1, self.__count + 1):
+      i = (self.__next - n) % self.__capacity
+      if self.__times[i] < since:
+        break
+      times.append(self.__times[i])
+      values.append(self.__values[i])
+    times.reverse()
+    values.reverse()
+    return times, values
+
+  def stats(self, since):
+    """Return min/max/avg over the samples taken at or after since."""
+    _, values = self.window(since)
+    if not values:
+      return {'count': 0, 'min': None, 'max': None, 'avg': None}
+    return {'count': len(values), 'min': min(values), 'max': max(values),
+            'avg': sum(values) / len(values)}
+
+
+class SensorSampler:
+  """Periodically samples every temperature and fan sensor into ring buffers."""
+
+  def __init__(self, logger, hwmon, sensors, period=SENSOR_PERIOD, history=SENSOR_HISTORY,
+               publish=None):
+    """Init."""
+    self.__log = logger
+    self.__publish = publish
+    self.__hwmon = hwmon
+    self.__period = period
+    self.__sensors = {sensor.name: sensor for sensor in sensors}
+    self.__rings = {sensor.name: SampleRing(history) for sensor in sensors}
+
+    # Group the sensors per chip, so each chip is visited once per sample
+    self.__chips = {}
+    for sensor in sensors:
+      self.__chips.setdefault(sensor.chip, []).append(sensor)
+
+  @property
+  def period(self):
+    """Sampling period, in seconds."""
+    return self.__period
+
+  def latest(self, name, since=0.0):
+    """Latest value of a sensor, or None if there is none since that time."""
+    latest = self.__rings[name].latest()
+    return latest[1] if latest and latest[0] >= since else None
+
+  def sample(self):
+    """Take one sample of every sensor. Returns the {sensor: value} sampled."""
+    now = time.time()
+    samples = {}
+    for chip, sensors in self.__chips.items():
+      try:
+        with metrics.timer('sensors', 'read_chip'):
+          values = self.__hwmon.read_chip(chip, [sensor.key for sensor in sensors])
+      except Exception as e:
+        self.__log.error(f'Failed to sample chip {chip}', exc_info=e)
+        metrics.count('sensors', 'errors')
+        continue
+      for sensor in sensors:
+        try:
+          value = float(values[sensor.key])
+        except (KeyError, ValueError) as e:
+          self.__log.error(f'Invalid sample for {sensor.name}', exc_info=e)
+          continue
+        self.__rings[sensor.name].append(now, value)
+        samples[sensor.name] = value
+        if self.__publish:
+          self.__publish('sensor', sensor.name, {'value': value})
+    return samples
+
+  def command(self, args):
+    """Command."""
+    usage = 'Usage: sensor <name|all> [latest|stats|series] [window_seconds]'
+    if len(args) < 1 or len(args) > 3:
+      return usage
+    names = list(self.__sensors) if args[0] == 'all' else [args[0]]
+    if any(name not in self.__sensors for name in names):
+      return f'Unknown sensor: {args[0]}'
+    query = args[1] if len(args) > 1 else 'latest'
+    try:
+      window = float(args[2]) if len(args) > 2 else self.__period * 12
+    except ValueError:
+      return usage
+
+    since = time.time() - window
+    res = {}
+    for name in names:
+      ring = self.__rings[name]
+      if query == 'latest':
+        latest = ring.latest()
+        res[name] = {'time': latest[0], 'value': latest[1]} if latest else None
+      elif query == 'stats':
+        res[name] = dict(ring.stats(since), window=window)
+      elif query == 'series':
+        times, values = ring.window(since)
+        res[name] = {'times': times, 'values': values}
+      else:
+        return usage
+    return res if args[0] == 'all' else res[args[0]]
+
+
+def write_sysfs(path, value):
+  """Write a value to a sysfs attribute."""
+  with open(path, 'w') as f:
+    f.write(f'{value}\n')
+
+
+class FanCurve:
+  """Duty cycle as a piecewise linear function of the temperature.
+
+  Between points the duty is interpolated, outside of them it is the one of
+  the nearest point.
+  """
+
+  def __init__(self, points):
+    """Init, from [[temp, duty], ...] points."""
+    points = sorted((float(temp), float(duty)) for temp, duty in points)
+    if not points:
+      raise ValueError('A fan curve needs at least one point')
+    self.__temps = [temp for temp, _ in points]
+    self.__duties = [duty for _, duty in points]
+
+  def __call__(self, temp):
+    """Duty, in percent, at temp."""
+    i = bisect.bisect_right(self.__temps, temp)
+    if i == 0:
+      return self.__duties[0]
+    if i == len(self.__temps):
+      return self.__duties[-1]
+    t0, t1 = self.__temps[i - 1], self.__temps[i]
+    d0, d1 = self.__duties[i - 1], self.__duties[i]
+    return d0 + (d1 - d0) * (temp - t0) / (t1 - t0)
+
+
+class FanPid:
+  """PID regulation of the temperature around a target.
+
+  The integral only accumulates while the output isn't saturated, so it
+  doesn't wind up while the fan is already at its limits.
+  """
+
+  def __init__(self, target, kp, ki=0.0, kd=0.0):
+    """Init."""
+    self.target = float(target)
+    self.__kp, self.__ki, self.__kd = float(kp), float(ki), float(kd)
+    self.__integral = 0.0
+    self.__error = None
+
+  def update(self, temp, dt, low, high, deadband):
+    """Duty, in percent, for the temperature measured dt seconds after the previous one."""
+    error = temp - self.target
+    if abs(error) < deadband:
+      error = 0.0
+    derivative = (error - self.__error) / dt if self.__error is not None and dt > 0 else 0.0
+    self.__error = error
+    proportional = low + self.__kp * error + self.__kd * derivative
+    integral = self.__integral + self.__ki * error * dt
+    if low <= proportional + integral <= high:
+      self.__integral = integral
+    return min(high, max(low, proportional + self.__integral))
+
+
+class FanLoop:
+  """Control loop of one fan: its sensors, its law and the PWM it drives."""
+
+  def __init__(self, fan, config):
+    """Init. Raises ValueError on an invalid configuration."""
+    if not isinstance(config, dict):
+      raise ValueError(f'{fan.name} needs an object, got: {config!r}')
+    self.fan = fan
+    self.pwm = config.get('pwm', fan.key.split('_')[0].replace('fan', 'pwm'))
+    if not (isinstance(self.pwm, str) and self.pwm.startswith('pwm') and self.pwm[3:].isdigit()):
+      raise ValueError(f'{fan.name} needs a pwmN attribute, got: {self.pwm!r}')
+    sensors = config.get('sensors', [])
+    self.sensors = sensors if isinstance(sensors, list) else [sensors]
+    unknown = [name for name in self.sensors
+               if not isinstance(name, str) or name not in hardware.temp]
+    if not self.sensors or unknown:
+      raise ValueError(f'{fan.name} needs known temperature sensors, got: {sensors!r}')
+    if ('curve' in config) == ('pid' in config):
+      raise ValueError(f'{fan.name} needs either a curve or a pid')
+    # Malformed points, unknown pid keys and non numbers all end up here
+    try:
+      self.curve = FanCurve(config['curve']) if 'curve' in config else None
+      self.pid = FanPid(**config['pid']) if 'pid' in config else None
+      self.hysteresis = float(config.get('hysteresis', 2.0))
+      self.low = float(config.get('min', 20.0))
+      self.high = float(config.get('max', 100.0))
+      self.rate = float(config.get('rate', 5.0))
+    except (TypeError, ValueError) as e:
+      raise ValueError(f'Invalid configuration of {fan.name}: {e}') from e
+    if not 0 <= self.low <= self.high <= 100:
+      raise ValueError(f'{fan.name} needs 0 <= min <= max <= 100')
+
+    # Duty applied, its PWM value, and when it was last updated
+    self.duty = None
+    self.written = None
+    self.updated = None
+    self.temp = None
+
+  def target(self, temp, now):
+    """Duty to move towards, before rate limiting."""
+    dt = now - self.updated if self.updated is not None else 0.0
+    if self.pid is not None:
+      return self.pid.update(temp, dt, self.low, self.high, self.hysteresis)
+    # Going up follows the curve, going down waits for the temperature to
+    # drop hysteresis degrees below the one the current duty was set for
+    rising = self.curve(temp)
+    falling = self.curve(temp + self.hysteresis)
+    if self.duty is None or rising > self.duty:
+      duty = rising
+    elif falling < self.duty:
+      duty = falling
+    else:
+      duty = self.duty
+    return min(self.high, max(self.low, duty))
+
+  def step(self, temp, now):
+    """Move the duty towards its target, at most rate percent per second. Returns it."""
+    target = self.target(temp, now) if temp is not None else self.high
+    if self.duty is None:
+      duty = target
+    else:
+      limit = self.rate * (now - self.updated)
+      duty = min(self.duty + limit, max(self.duty - limit, target))
+    self.duty, self.updated, self.temp = duty, now, temp
+    return duty
+
+
+class FanController:
+  """Drives the fans from the temperatures, through the hwmon PWM attributes.
+
+  Each fan follows a curve or a PID over the hottest of its sensors. PWM
+  values are only written when they change. Taking control switches the fans
+  to manual mode (pwmN_enable=1). Giving it back restores the previous modes,
+  and so does a watchdog process if the daemon dies without doing it.
+  """
+
+  # pwmN_enable values of the f71882fg driver
+  MANUAL = 1
+  AUTO = 2
+
+  def __init__(self, logger, hwmon, sampler, config, period=SENSOR_PERIOD):
+    """Init. Raises ValueError on an invalid configuration."""
+    self.__log = logger
+    self.__hwmon = hwmon
+    self.__sampler = sampler
+    self.__stale = 3 * period
+    self.__loops = []
+    if not isinstance(config, dict):
+      raise ValueError(f'The fan control configuration must be an object, got: {config!r}')
+    for name, fan_config in config.items():
+      if name not in hardware.fan:
+        raise ValueError(f'Unknown fan: {name}')
+      self.__loops.append(FanLoop(hardware.fan[name], fan_config))
+    # {pwm_enable path: value to restore}, while in control
+    self.__restore = None
+    self.__watchdog = None
+    # {fan name: hwmon directory}, resolved when taking control
+    self.__dirs = {}
+
+  @property
+  def active(self):
+    """Whether the fans are under control of the daemon."""
+    return self.__restore is not None
+
+  def take_control(self):
+    """Switch the fans to manual mode, remembering their previous mode."""
+    if self.active or not self.__loops:
+      return
+    self.__resolve()
+    restore = {}
+    for loop in self.__loops:
+      enable = self.__path(loop, '_enable')
+      try:
+        with open(enable) as f:
+          restore[enable] = int(f.read().strip())
+      except (OSError, ValueError):
+        restore[enable] = self.AUTO
+    # The watchdog must be ready before the first fan leaves its mode
+    self.__watchdog = Popen([sys.executable, os.path.realpath(__file__), FAN_WATCHDOG]
+                            + [f'{path}={value}' for path, value in restore.items()],
+                            stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+    self.__restore = restore
+    for loop in self.__loops:
+      loop.duty = loop.written = loop.updated = None
+      write_sysfs(self.__path(loop, '_enable'), self.MANUAL)
+    self.__log.info(f'Fans under control, previous modes: {restore}')
+    self.update()
+
+  def give_back(self):
+    """Restore the previous mode of the fans."""
+    if not self.active:
+      return
+    for path, value in self.__restore.items():
+      try:
+        write_sysfs(path, value)
+      except OSError as e:
+        self.__log.error(f'Failed to restore {path} to {value}', exc_info=e)
+    self.__restore = None
+    # The watchdog restores them again on EOF, which does no harm
+    self.__watchdog.stdin.close()
+    try:
+      self.__watchdog.wait(timeout=5)
+    except TimeoutExpired:
+      self.__watchdog.kill()
+    self.__watchdog = None
+    self.__log.info('Fans given back to the hardware')
+
+  def update(self):
+    """Apply the latest temperatures to the fans."""
+    if not self.active:
+      return
+    if self.__watchdog.poll() is not None:
+      self.__log.error(f'Fan watchdog exited with {self.__watchdog.returncode}.'
+                       ' Giving control back')
+      self.give_back()
+      return
+    now = time.time()
+    for loop in self.__loops:
+      temps = [value for value in (self.__sampler.latest(name, now - self.__stale)
+                                   for name in loop.sensors) if value is not None]
+      # Without any recent temperature, the fan runs at its maximum
+      duty = loop.step(max(temps) if temps else None, now)
+      value = round(duty * 255 / 100)
+      if value == loop.written:
+        continue
+      try:
+        write_sysfs(self.__path(loop), value)
+        loop.written = value
+        metrics.count('fans', 'writes')
+      except OSError as e:
+        self.__log.error(f'Failed to set {loop.fan.name} to {value}', exc_info=e)
+        metrics.count('fans', 'errors')
+
+  def command(self, args):
+    """Command."""
+    usage = 'Usage: fanctl [on|off]'
+    if len(args) > 1:
+      return usage
+    if args == ['on']:
+      try:
+        self.take_control()
+      except OSError as e:
+        self.__log.error('Failed to take control of the fans', exc_info=e)
+        self.give_back()
+        return f'Failed to take control of the fans: {e}'
+    elif args == ['off']:
+      self.give_back()
+    elif args:
+      return usage
+    return {
+      'active': self.active,
+      'fans': {loop.fan.name: {'sensors': loop.sensors, 'temp': loop.temp, 'duty': loop.duty,
+                               'pwm': loop.written, 'law': 'pid' if loop.pid else 'curve'}
+               for loop in self.__loops},
+    }
+
+  def __resolve(self):
+    """Resolve the PWM attributes from sysfs, rather than from the saved index."""
+    dirs = {}
+    for loop in self.__loops:
+      directory = self.__hwmon.chip_dir(loop.fan.chip, refresh=not dirs)
+      if directory is None:
+        raise OSError(f'No hwmon directory for {loop.fan.chip}')
+      for suffix in ('', '_enable'):
+        path = os.path.join(directory, loop.pwm + suffix)
+        if os.path.islink(path) or not os.path.isfile(path):
+          raise OSError(f'Not a PWM attribute: {path}')
+      dirs[loop.fan.name] = directory
+    self.__dirs = dirs
+
+  def __path(self, loop, suffix=''):
+    return os.path.join(self.__dirs[loop.fan.name], loop.pwm + suffix)
+
+
+def load_fan_config():
+  """Fan control configuration: QHAL_FAN_CONFIG, else the one of the hardware map."""
+  if FAN_CONFIG:
+    with open(FAN_CONFIG) as f:
+      return json.load(f)
+  return hardware.fan_control
+
+
+def fan_watchdog(restore):
+  """Restore fan modes once stdin is closed, i.e. once the daemon is gone.
+
+  restore holds 'path=value' strings. Runs as a separate process, since it
+  must outlive the daemon.
+  """
+  def restore_and_exit(*_):
+    for item in restore:
+      path, _, value = item.rpartition('=')
+      try:
+        write_sysfs(path, value)
+      except OSError:
+        pass
+    os._exit(0)
+
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, restore_and_exit)
+  signal.signal(signal.SIGHUP, restore_and_exit)
+  while sys.stdin.buffer.read(4096):
+    pass
+  restore_and_exit()
+
+
+class AlertRule:
+  """A condition on one sensor, evaluated on each of its samples in O(1).
+
+  Types of rules:
+  - threshold: the value is above (or below) a level
+  - rate: the rate of change, smoothed by an EWMA over tau seconds, is above
+    (or below) a level, in units per minute
+  - stall: a fan is below a speed, 200 RPM by default, for 15 seconds by default
+
+  A rule is raised once its condition held for 'for' seconds, and cleared once
+  the watched value is back beyond the 'clear' level, so it doesn't flap
+  around a single level.
+  """
+
+  TYPES = ('threshold', 'rate', 'stall')
+  ACTIONS = ('led', 'sound', 'lcd')
+
+  def __init__(self, config):
+    """Init. Raises ValueError on an invalid rule."""
+    self.name = str(config['name'])
+    self.sensor = config['sensor']
+    self.type = config.get('type', 'threshold')
+    if self.sensor not in hardware.sensor:
+      raise ValueError(f'Alert {self.name}: unknown sensor {self.sensor}')
+    if self.type not in self.TYPES:
+      raise ValueError(f'Alert {self.name}: unknown type {self.type}')
+    if self.type == 'stall' and self.sensor not in hardware.fan:
+      raise ValueError(f'Alert {self.name}: only fans can stall')
+    if self.type == 'stall':
+      config = dict({'below': 200, 'for': 15}, **config)
+    if ('above' in config) == ('below' in config):
+      raise ValueError(f'Alert {self.name}: needs either above or below')
+    self.rising = 'above' in config
+    self.level = float(config['above' if self.rising else 'below'])
+    # Without a clear level, the hysteresis is 5% of the level
+    margin = abs(self.level) * 0.05 or 1.0
+    self.clear = float(config.get('clear', self.level - margin if self.rising
+                                  else self.level + margin))
+    if self.rising != (self.clear <= self.level):
+      raise ValueError(f'Alert {self.name}: clear must be on the safe side of the level')
+    self.hold = float(config.get('for', 0.0))
+    self.tau = float(config.get('tau', 30.0))
+    self.actions = list(config.get('actions', self.ACTIONS))
+    if any(action not in self.ACTIONS for action in self.actions):
+      raise ValueError(f'Alert {self.name}: actions must be among {self.ACTIONS}')
+
+    self.active = False
+    self.signal = None
+    self.__since = None
+    self.__last = None
+
+  def feed(self, value, now):
+    """Feed a sample. Returns True when the rule is raised, False when cleared, else None."""
+    if self.type == 'rate':
+      if self.__last is None or now <= self.__last[0]:
+        self.__last = (now, value)
+        return None
+      (then, previous), self.__last = self.__last, (now, value)
+      rate = (value - previous) / (now - then) * 60
+      alpha = 1 - math.exp(-(now - then) / self.tau)
+      self.signal = rate if self.signal is None else self.signal + alpha * (rate - self.signal)
+    else:
+      self.signal = value
+
+    beyond = self.signal >= self.level if self.rising else self.signal <= self.level
+    if not self.active:
+      if not beyond:
+        self.__since = None
+        return None
+      if self.__since is None:
+        self.__since = now
+      if now - self.__since < self.hold:
+        return None
+      self.active = True
+      return True
+    safe = self.signal < self.clear if self.rising else self.signal > self.clear
+    if safe:
+      self.active = False
+      self.__since = None
+      return False
+    return None
+
+  def to_dict(self):
+    """Describe the rule for the 'alerts' command."""
+    return {'sensor': self.sensor, 'type': self.type, 'active': self.active,
+            'signal': self.signal, 'level': self.level, 'clear': self.clear}
+
+
+class AlertEngine:
+  """Evaluates the alert rules on the sensor samples, and acts on them.
+
+  While any alert with the 'led' action is active, Status_Red blinks. Raising
+  an alert plays the Alert sound and shows it on the LCD, depending on its
+  actions. Everything happens in the daemon: actions are calls to the LED,
+  buzzer and LCD handlers.
+  """
+
+  ALERT_LED = 'Status_Red'
+  ALERT_SOUND = 'Alert'
+
+  def __init__(self, logger, rules, leds, buzzer, lcd, publish=None):
+    """Init. Raises ValueError on invalid rules."""
+    self.__log = logger
+    self.__leds = leds
+    self.__buzzer = buzzer
+    self.__lcd = lcd
+    self.__publish = publish
+    self.__rules = [AlertRule(config) for config in rules]
+    if len({rule.name for rule in self.__rules}) != len(self.__rules):
+      raise ValueError('Duplicate alert names')
+    self.__by_sensor = {}
+    for rule in self.__rules:
+      self.__by_sensor.setdefault(rule.sensor, []).append(rule)
+    self.__blinking = False
+
+  def feed(self, samples, now):
+    """Evaluate the rules of the sensors sampled, from a {sensor: value} dict."""
+    for name, value in samples.items():
+      for rule in self.__by_sensor.get(name, ()):
+        change = rule.feed(value, now)
+        if change is not None:
+          self.__act(rule, change)
+
+  def command(self, args):
+    """Command."""
+    if args:
+      return 'Usage: alerts'
+    return {rule.name: rule.to_dict() for rule in self.__rules}
+
+  def __act(self, rule, raised):
+    state = 'raised' if raised else 'cleared'
+    message = f'Alert {rule.name} {state}: {rule.sensor} at {rule.signal:.1f}'
+    if raised:
+      self.__log.warning(message)
+    else:
+      self.__log.info(message)
+    metrics.count('alerts', state)
+    if self.__publish:
+      self.__publish('alert', rule.name, {'state': state, 'sensor': rule.sensor,
+                                          'signal': rule.signal})
+    try:
+      self.__update_led()
+      if raised and 'sound' in rule.actions:
+        self.__buzzer.play(hardware.sound[self.ALERT_SOUND])
+      if 'lcd' in rule.actions:
+        self.__lcd.write([rule.name if raised else 'Alert cleared',
+                          f'{rule.sensor} {rule.signal:.1f}'])
+    except Exception as e:
+      self.__log.error(f'Failed to act on alert {rule.name}', exc_info=e)
+
+  def __update_led(self):
+    led = hardware.led[self.ALERT_LED]
+    blink = any(rule.active and 'led' in rule.actions for rule in self.__rules)
+    if blink and not self.__blinking:
+      self.__leds.set_pattern(led, led_pattern('blink', ['2']))
+    elif not blink and self.__blinking:
+      self.__leds.clear_pattern(led)
+      self.__leds.set_led(led, 'off')
+    self.__blinking = blink
+
+
+def load_alert_config():
+  """Alert rules: QHAL_ALERT_CONFIG, else the ones of the hardware map."""
+  if ALERT_CONFIG:
+    with open(ALERT_CONFIG) as f:
+      return json.load(f)
+  return hardware.alerts
+
+
+UPS_ACTION = namedtuple('UPS_ACTION', ['sound', 'leds', 'message'])
+
+# What the front panel does for each NUT notification type: a sound, LED
+# states or patterns, and a message for the LCD. Other types are only logged.
+UPS_ACTIONS = {
+  'ONLINE': UPS_ACTION('Online', {'Status_Green': 'on'}, 'UPS on line'),
+  'ONBATT': UPS_ACTION('Outage', {'Status_Green': 'heartbeat'}, 'UPS on battery'),
+  'LOWBATT': UPS_ACTION('Alert', {'Status_Green': 'blink'}, 'UPS battery low'),
+  'FSD': UPS_ACTION('Error', {'Status_Green': 'off'}, 'UPS forced stop'),
+  'SHUTDOWN': UPS_ACTION(None, {'Status_Green': 'off'}, 'Shutting down'),
+  'COMMBAD': UPS_ACTION(None, {}, 'UPS comm lost'),
+  'NOCOMM': UPS_ACTION(None, {}, 'UPS unreachable'),
+  'COMMOK': UPS_ACTION(None, {}, 'UPS comm ok'),
+  'REPLBATT': UPS_ACTION('Alert', {}, 'Replace battery'),
+}
+
+
+class UpsHandler:
+  """Turns the NUT notifications of the UPSes into front panel actions.
+
+  Notifications of a UPS settle for UPS_SETTLE seconds before acting on them:
+  a burst, such as a flapping power line, only acts on its last notification,
+  and not at all if that is the one acted on before.
+  """
+
+  def __init__(self, logger, leds, buzzer, lcd, schedule, publish=None, settle=UPS_SETTLE):
+    """Init. schedule(delay, callback) runs callback once, after delay seconds."""
+    self.__log = logger
+    self.__leds = leds
+    self.__buzzer = buzzer
+    self.__lcd = lcd
+    self.__schedule = schedule
+    self.__publish = publish
+    self.__settle = settle
+    # {ups: [type, message, timer]} waiting to settle, and {ups: type} acted on
+    self.__pending = {}
+    self.__applied = {}
+
+  def command(self, args):
+    """Command."""
+    if len(args) < 2:
+      return 'Usage: ups <notify_type> <ups> [message]'
+    notify_type, ups, message = args[0].upper(), args[1], ' '.join(args[2:])
+    self.__log.info(f'UPS {ups}: {notify_type} {message}')
+    metrics.count('ups', 'events')
+    if self.__publish:
+      self.__publish('ups', ups, {'type': notify_type, 'message': message})
+    pending = self.__pending.get(ups)
+    if pending is not None:
+      metrics.count('ups', 'coalesced')
+      pending[:2] = [notify_type, message]
+    else:
+      self.__pending[ups] = [notify_type, message,
+                             self.__schedule(self.__settle, self.__settled, ups)]
+    return f'UPS {ups}: {notify_type} queued'
+
+  def __settled(self, ups):
+    notify_type, message, _ = self.__pending.pop(ups)
+    if self.__applied.get(ups) == notify_type:
+      self.__log.info(f'UPS {ups}: {notify_type} was already handled')
+      return
+    self.__applied[ups] = notify_type
+    action = UPS_ACTIONS.get(notify_type)
+    if action is None:
+      return
+    self.__log.info(f'UPS {ups}: acting on {notify_type}')
+    metrics.count('ups', 'actions')
+    try:
+      if action.sound:
+        self.__buzzer.play(hardware.sound[action.sound])
+      for name, state in action.leds.items():
+        led = hardware.led[name]
+        if state in LED_PATTERNS:
+          self.__leds.set_pattern(led, led_pattern(state, []))
+        else:
+          self.__leds.clear_pattern(led)
+          self.__leds.set_led(led, state)
+      self.__lcd.write([action.message, ups])
+    except Exception as e:
+      self.__log.error(f'Failed to act on UPS {ups} {notify_type}', exc_info=e)
+
+
+def read_env_file(filename):
+  """Read the plain KEY=VALUE lines of a shell env file.
+
+  Values still encrypted by sops (ENC[...]) are skipped, since only the shell
+  scripts can decrypt them.
+  """
+  values = {}
+  try:
+    with open(filename) as f:
+      lines = f.readlines()
+  except OSError:
+    return values
+  for line in lines:
+    name, sep, value = line.strip().partition('=')
+    if not sep or name.startswith('#'):
+      continue
+    value = value.strip().strip('"\'')
+    if not value.startswith('ENC['):
+      values[name.strip()] = value
+  return values
+
+
+def disk_bays(env, sys_block=SYS_BLOCK):
+  """Map disk names (e.g. sda) to their bay numbers, 1 being Disk1.
+
+  Bays come from the D<i>_DEV of nas.env, as identified by the storage scripts.
+  Bays it lacks are worked out like those scripts do: the disks attached to
+  the DRIVE<i>_CTRL controller, recognised by its DRIVE_CONTROLLER<n>_PREFIX
+  device path, taken in the order of their ata ports.
+  """
+  count = int(env.get('DRIVE_MAX') or len(DISK_ERROR_LEDS))
+  bays = {}
+  for i in range(1, count + 1):
+    dev = env.get(f'D{i}_DEV')
+    if dev:
+      bays[os.path.basename(dev)] = i
+
+  missing = [i for i in range(1, count + 1) if i not in bays.values()]
+  prefixes = {n: env[f'DRIVE_CONTROLLER{n}_PREFIX'] for n in range(1, 10)
+              if env.get(f'DRIVE_CONTROLLER{n}_PREFIX')}
+  if not missing or not prefixes:
+    return bays
+  # {controller: [(ata port, disk), ...]} of the disks not in a bay yet
+  attached = {}
+  try:
+    disks = sorted(os.listdir(sys_block))
+  except OSError:
+    disks = []
+  for disk in disks:
+    if disk in bays:
+      continue
+    path = os.path.realpath(os.path.join(sys_block, disk))
+    # The storage scripts use the udev path, without /sys
+    udev_path = path[len('/sys'):] if path.startswith('/sys/') else path
+    ata = next((part for part in path.split('/') if part.startswith('ata')), '')
+    for n, prefix in prefixes.items():
+      if path.startswith(prefix) or udev_path.startswith(prefix):
+        attached.setdefault(n, []).append((ata, disk))
+  for disks in attached.values():
+    disks.sort()
+  for i in missing:
+    try:
+      controller = int(env.get(f'DRIVE{i}_CTRL', ''))
+    except ValueError:
+      continue
+    if attached.get(controller):
+      bays[attached[controller].pop(0)[1]] = i
+  return bays
+
+
+def load_disk_bays():
+  """Map disk names to bays, from hardware.env, nas.env and the environment."""
+  env = read_env_file(f'{ROOT}/data/hardware.env')
+  env.update(read_env_file(os.path.join(os.environ.get('CONFIG_DIR', ''), 'nas.env')))
+  env.update(os.environ)
+  return disk_bays(env)
+
+
+MD_ARRAY = namedtuple('MD_ARRAY', ['name', 'state', 'level', 'members', 'status', 'progress'])
+
+
+def parse_md_array(block):
+  """Parse the lines of one array of /proc/mdstat into an MD_ARRAY.
+
+  Members map device names to 'active', 'faulty', 'spare' or 'replacement'.
+  Progress is None, or the recovery, resync, reshape or check in progress.
+  """
+  lines = block.splitlines()
+  name, _, rest = lines[0].partition(' : ')
+  words = rest.split()
+  state = words[0] if words else 'unknown'
+  level = next((word for word in words[1:] if not word.startswith('(')
+                and '[' not in word), None) if state == 'active' else None
+  members = {}
+  for word in words:
+    if '[' in word:
+      dev, _, flags = word.partition('[')
+      flags = flags.split(']', 1)[1]
+      members[dev] = ('faulty' if '(F)' in flags else 'spare' if '(S)' in flags
+                      else 'replacement' if '(R)' in flags else 'active')
+  status = None
+  progress = None
+  for line in lines[1:]:
+    line = line.strip()
+    if line.endswith(']') and '[' in line and ' blocks' in line:
+      status = line.rsplit(' ', 1)[1].strip('[]')
+    for action in ('recovery', 'resync', 'reshape', 'check', 'repair'):
+      if line.startswith(('[', action)) and f'{action} =' in line:
+        fields = line.split(f'{action} =', 1)[1].split()
+        progress = {'action': action, 'percent': float(fields[0].rstrip('%'))}
+        for field in fields[1:]:
+          key, _, value = field.partition('=')
+          if key == 'finish':
+            progress['finish_minutes'] = float(value.rstrip('min'))
+          elif key == 'speed':
+            progress['speed_kbs'] = float(value.split('K')[0])
+      elif line.startswith(f'{action}='):
+        progress = {'action': action, 'percent': None, 'state': line.split('=', 1)[1]}
+  return MD_ARRAY(name.strip(), state, level, members, status, progress)
+
+
+class RaidMonitor:
+  """Follows the md arrays and shows the failed disks on the Disk*_Error LEDs.
+
+  The kernel flags /proc/mdstat with POLLPRI when an array changes, so a
+  thread waits for that instead of re-reading the file periodically, and
+  hands the new content to the loop. Only arrays whose lines changed are
+  parsed again. A disk is in error when it is faulty, or when it left a
+  degraded array it used to be a member of.
+
+  Error LEDs claimed by a command or a pattern are left alone, and set again
+  by the first update after they are given back: the file is read at least
+  every MDSTAT_FALLBACK seconds.
+  """
+
+  def __init__(self, logger, leds, path=MDSTAT_PATH, publish=None):
+    """Init."""
+    self.__log = logger
+    self.__leds = leds
+    self.__path = path
+    self.__publish = publish
+    self.__bays = None
+    self.__partitions = {}
+    # {array name: (lines, MD_ARRAY)}, and the members ever seen per array
+    self.__arrays = {}
+    self.__seen = {}
+    self.__errors = None
+    self.__stop_r = self.__stop_w = None
+    self.__thread = None
+
+  def start(self, post):
+    """Start watching. post(callback, text) must run callback on the loop."""
+    if not os.path.exists(self.__path):
+      self.__log.info(f'No {self.__path}, RAID arrays are not monitored')
+      return
+    self.__stop_r, self.__stop_w = os.pipe()
+    self.__thread = threading.Thread(target=self.__watch, args=(post,), name='mdstat',
+                                     daemon=True)
+    self.__thread.start()
+
+  def stop(self):
+    """Stop watching."""
+    if self.__thread is not None:
+      os.write(self.__stop_w, b'\0')
+      self.__thread.join()
+      os.close(self.__stop_r)
+      os.close(self.__stop_w)
+      self.__thread = None
+
+  def update(self, text):
+    """Apply a new content of /proc/mdstat."""
+    # Each array starts with its 'mdN : ' line, and ends before a blank line
+    blocks = {}
+    name = None
+    for line in text.splitlines():
+      if line.startswith('md') and ' : ' in line:
+        name = line.split(' : ', 1)[0].strip()
+        blocks[name] = line
+      elif not line.strip():
+        name = None
+      elif name is not None:
+        blocks[name] += '\n' + line
+
+    for name in list(self.__arrays):
+      if name not in blocks:
+        self.__log.info(f'RAID array {name} is gone')
+        del self.__arrays[name]
+        self.__seen.pop(name, None)
+    for name, lines in blocks.items():
+      if name in self.__arrays and self.__arrays[name][0] == lines:
+        continue
+      md = parse_md_array(lines)
+      previous = self.__arrays.get(name, (None, None))[1]
+      self.__arrays[name] = (lines, md)
+      metrics.count('raid', 'parsed')
+      if previous is None or (previous.state, previous.members, previous.status) != \
+         (md.state, md.members, md.status):
+        self.__seen.setdefault(name, set()).update(md.members)
+        self.__log.info(f'RAID array {name}: {md.state} {md.level} [{md.status}]'
+                        f' {md.members}')
+        if self.__publish:
+          self.__publish('raid', name, self.__describe(md))
+    self.__show_errors()
+
+  def command(self, args):
+    """Command."""
+    if len(args) > 1:
+      return 'Usage: raid [array]'
+    # Progress doesn't notify, so queries read the file again
+    try:
+      with open(self.__path) as f:
+        self.update(f.read())
+    except OSError as e:
+      return f'Failed to read {self.__path}: {e}'
+    arrays = {name: self.__describe(md) for name, (_, md) in self.__arrays.items()}
+    if args:
+      return arrays.get(args[0], f'Unknown array: {args[0]}')
+    return arrays
+
+  def __describe(self, md):
+    bays = self.__disk_bays()
+    return {'state': md.state, 'level': md.level, 'status': md.status,
+            'progress': md.progress,
+            'members': {dev: {'state': state, 'bay': bays.get(self.__disk(dev))}
+                        for dev, state in md.members.items()}}
+
+  def __show_errors(self):
+    bays = self.__disk_bays()
+    errors = set()
+    for name, (_, md) in self.__arrays.items():
+      failed = {dev for dev, state in md.members.items() if state == 'faulty'}
+      if md.status and '_' in md.status:
+        failed |= self.__seen.get(name, set()) - set(md.members)
+      errors |= {bays[self.__disk(dev)] for dev in failed if self.__disk(dev) in bays}
+    if errors != self.__errors:
+      self.__errors = errors
+      self.__log.info(f'Disks in error: {sorted(errors) or "none"}')
+    states = {}
+    for bay, name in enumerate(DISK_ERROR_LEDS, 1):
+      led = hardware.led.get(name)
+      if led is None or self.__leds.claimed(led):
+        continue
+      if self.__leds.is_on(led) != (bay in errors):
+        states[led] = 'on' if bay in errors else 'off'
+    if not states:
+      return
+    try:
+      self.__leds.set_leds(states)
+    except Exception as e:
+      self.__log.error('Failed to update the disk error LEDs', exc_info=e)
+
+  def __disk_bays(self):
+    if self.__bays is None:
+      self.__bays = load_disk_bays()
+      self.__log.info(f'Disk bays: {self.__bays}')
+    return self.__bays
+
+  def __disk(self, dev):
+    # Arrays are usually made of partitions, bays hold whole disks
+    if dev not in self.__partitions:
+      path = os.path.join(SYS_BLOCK_CLASS, dev)
+      if os.path.exists(os.path.join(path, 'partition')):
+        self.__partitions[dev] = os.path.basename(os.path.dirname(os.path.realpath(path)))
+      else:
+        self.__partitions[dev] = dev
+    return self.__partitions[dev]
+
+  def __watch(self, post):
+    try:
+      with open(self.__path) as f:
+        poller = select.poll()
+        poller.register(f, select.POLLPRI | select.POLLERR)
+        poller.register(self.__stop_r, select.POLLIN)
+        while True:
+          f.seek(0)
+          post(self.update, f.read())
+          events = poller.poll(MDSTAT_FALLBACK * 1000)
+          if any(fd == self.__stop_r for fd, _ in events):
+            return
+          metrics.count('raid', 'wakeups')
+    except Exception as e:
+      self.__log.error(f'Stopped watching {self.__path}', exc_info=e)
+
+
+class DiskActivity:
+  """Blinks the Disk*_Present LEDs with the I/O of the disks in their bays.
+
+  The LED of a bay is lit while it holds a disk, and goes dark for up to half
+  of the ticks, in proportion to how busy the disk was since the previous
+  tick. /proc/diskstats is read with a single pread() of a descriptor kept
+  open, and only the lines of the bay disks are split, found at the line
+  index they had last time. LEDs are only written when one of them changes,
+  all in one batch, and without publishing events. LEDs claimed by a command
+  or a pattern are left alone.
+  """
+
+  # Index of the milliseconds spent doing I/O in a split line of diskstats
+  IO_TICKS = 12
+
+  def __init__(self, logger, leds, path=DISKSTATS_PATH):
+    """Init."""
+    self.__log = logger
+    self.__leds = leds
+    self.__path = path
+    self.__fd = None
+    # [led, disk, line index, io_ticks, time, accumulator]
+    self.__disks = []
+
+  def start(self):
+    """Resolve the disks in the bays having an LED. Returns False if there is nothing to do."""
+    bays = {bay: disk for disk, bay in load_disk_bays().items()}
+    for led in hardware.leds:
+      if led.name.startswith('Disk') and led.name.endswith('_Present'):
+        disk = bays.get(int(led.name[4:-len('_Present')]))
+        if disk:
+          self.__disks.append([led, disk.encode(), None, None, None, 0.0])
+    if not self.__disks:
+      self.__log.info('No disk in the bays with an activity LED')
+      return False
+    try:
+      self.__fd = os.open(self.__path, os.O_RDONLY)
+    except OSError as e:
+      self.__log.warning(f'Disk activity is not shown, failed to open {self.__path}', exc_info=e)
+      return False
+    self.__log.info('Showing the activity of:'
+                    f' {[(entry[0].name, entry[1].decode()) for entry in self.__disks]}')
+    return True
+
+  def stop(self):
+    """Stop reading the disk statistics."""
+    if self.__fd is not None:
+      os.close(self.__fd)
+      self.__fd = None
+
+  def tick(self):
+    """Sample the disks and update their LEDs."""
+    data = os.pread(self.__fd, DISKSTATS_MAX_SIZE, 0)
+    now = time.monotonic()
+    lines = data.split(b'\n')
+    changes = {}
+    for entry in self.__disks:
+      led, disk, index, io_ticks, then, acc = entry
+      if self.__leds.claimed(led):
+        continue
+      # Whatever wrote the LED last, such as a pattern that just ended
+      lit = self.__leds.is_on(led)
+      fields = lines[index].split() if index is not None and index < len(lines) else None
+      if not fields or fields[2] != disk:
+        # Lines only move when block devices come and go
+        index = next((i for i, line in enumerate(lines) if line.split()[2:3] == [disk]), None)
+        fields = lines[index].split() if index is not None else None
+        entry[2] = index
+      if fields is None:
+        entry[3:] = [None, None, 0.0]
+        if lit is not False:
+          changes[led] = 'off'
+        continue
+      ticks = int(fields[self.IO_TICKS])
+      busy = 0.0
+      if io_ticks is not None and now > then:
+        busy = min(1.0, max(0.0, (ticks - io_ticks) / 1000 / (now - then)))
+      # Sigma-delta: the LED is dark for busy / 2 of the ticks
+      acc += busy / 2
+      dark = acc >= 0.5
+      if dark:
+        acc -= 1.0
+      entry[3:] = [ticks, now, acc]
+      if lit != (not dark):
+        changes[led] = 'off' if dark else 'on'
+    if changes:
+      metrics.count('disks', 'led_writes')
+      self.__leds.set_leds(changes, with_logs=False, publish=False)
+
+
+class SmartCache:
+  """Keeps the SMART data of the bay disks and of the NVMe drives.
+
+  Every SMART_PERIOD seconds, smartctl is run for each drive by a pool of
+  SMART_WORKERS threads, which bounds how many smartctl processes run at
+  once. Drives in standby are not woken up (-n standby): they keep their
+  previous data, which gets older. SATA disks that smartctl can't handle as
+  ATA are retried as SCSI, like the smartd scripts do.
+  """
+
+  def __init__(self, logger, smartctl=SMARTCTL, workers=SMART_WORKERS, timeout=SMART_TIMEOUT):
+    """Init."""
+    self.__log = logger
+    self.__smartctl = smartctl
+    self.__workers = workers
+    self.__timeout = timeout
+    self.__lock = threading.Lock()
+    self.__pool = None
+    # {device: cache entry}, and the devices being refreshed
+    self.__cache = {}
+    self.__running = set()
+
+  def start(self):
+    """Find the drives and start the pool."""
+    from concurrent.futures import ThreadPoolExecutor
+    bays = load_disk_bays()
+    try:
+      nvmes = sorted(dev for dev in os.listdir(SYS_BLOCK)
+                     if dev.startswith('nvme') and 'n' in dev[4:] and 'p' not in dev[4:])
+    except OSError:
+      nvmes = []
+    for dev in sorted(bays) + nvmes:
+      self.__cache[dev] = {'bay': bays.get(dev), 'updated': None, 'checked': None,
+                           'standby': None, 'error': None, 'data': None}
+    self.__pool = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix='smart')
+    self.__log.info(f'SMART data cached for: {list(self.__cache)}')
+
+  def stop(self):
+    """Stop the pool. Running smartctl processes are left to finish."""
+    if self.__pool is not None:
+      self.__pool.shutdown(wait=False)
+      self.__pool = None
+
+  def refresh(self):
+    """Queue a refresh of every drive not being refreshed yet."""
+    if self.__pool is None:
+      return
+    with self.__lock:
+      devices = [dev for dev in self.__cache if dev not in self.__running]
+      self.__running.update(devices)
+    for dev in devices:
+      self.__pool.submit(self.__refresh, dev)
+
+  def command(self, args):
+    """Command."""
+    usage = 'Usage: smart <all|refresh|device>'
+    if len(args) != 1:
+      return usage
+    if args[0] == 'refresh':
+      self.refresh()
+      return f'Refreshing the SMART data of {len(self.__cache)} drive(s)'
+    now = time.time()
+    with self.__lock:
+      entries = {dev: dict(entry, age=now - entry['updated'] if entry['updated'] else None)
+                 for dev, entry in self.__cache.items()
+                 if args[0] in ('all', dev, f'/dev/{dev}')}
+    if args[0] == 'all':
+      return entries
+    return next(iter(entries.values()), f'Unknown device: {args[0]}')
+
+  def __refresh(self, dev):
+    try:
+      with metrics.timer('smart', 'refresh'):
+        entry = self.__collect(dev)
+    except Exception as e:
+      self.__log.error(f'Failed to read the SMART data of {dev}', exc_info=e)
+      entry = {'error': str(e)}
+    entry['checked'] = time.time()
+    metrics.count('smart', 'standby' if entry.get('standby') else
+                  'errors' if entry.get('error') else 'updates')
+    with self.__lock:
+      self.__cache[dev].update(entry)
+      self.__running.discard(dev)
+
+  def __collect(self, dev):
+    if dev.startswith('nvme'):
+      attempts = [['-d', 'nvme']]
+    else:
+      attempts = [[], ['-d', 'scsi']]
+    for options in attempts:
+      res = run([self.__smartctl, '--json', '-a', '-n', 'standby'] + options + [f'/dev/{dev}'],
+                stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=self.__timeout)
+      try:
+        report = json.loads(res.stdout)
+      except ValueError:
+        report = {}
+      messages = ' '.join(message.get('string', '') for message in
+                          report.get('smartctl', {}).get('messages', []))
+      if 'STANDBY' in messages.upper():
+        return {'standby': True, 'error': None}
+      # Bits 0 and 1 of the exit status: the command or the device failed
+      if report and not res.returncode & 3:
+        return {'standby': False, 'error': None, 'updated': time.time(),
+                'data': self.parse(report)}
+    return {'standby': False,
+            'error': messages or res.stderr.strip() or f'smartctl exited with {res.returncode}'}
+
+  @staticmethod
+  def parse(report):
+    """Keep the useful parts of a smartctl --json report."""
+    data = {
+      'model': report.get('model_name'),
+      'serial': report.get('serial_number'),
+      'passed': report.get('smart_status', {}).get('passed'),
+      'temperature': report.get('temperature', {}).get('current'),
+      'power_on_hours': report.get('power_on_time', {}).get('hours'),
+    }
+    table = report.get('ata_smart_attributes', {}).get('table')
+    if table is not None:
+      data['attributes'] = {
+        attribute['name']: {'id': attribute.get('id'), 'value': attribute.get('value'),
+                            'worst': attribute.get('worst'), 'thresh': attribute.get('thresh'),
+                            'raw': attribute.get('raw', {}).get('value')}
+        for attribute in table}
+    if 'nvme_smart_health_information_log' in report:
+      data['attributes'] = report['nvme_smart_health_information_log']
+    return data
+
+
+class HwmonReader:
+  """Reads sensors straight from the hwmon sysfs interface.
+
+  Chips are named the way lm-sensors does (e.g. f71869a-isa-0a20). The index
+  mapping those names to /sys/class/hwmon/hwmonN directories is built once and
+  persisted, since hwmon numbering only changes when drivers are reloaded.
+  Chips that cannot be resolved are read through `sensors -u` instead.
+  A relative cache_file is relative to ROOT.
+  """
+
+  # Scale between the sysfs units and the ones reported by `sensors -u`
+  SCALES = {'temp': 1000, 'in': 1000, 'curr': 1000, 'power': 1000000, 'energy': 1000000}
+
+  def __init__(self, logger, root=HWMON_ROOT, cache_file=HWMON_CACHE):
+    """Init."""
+    self.__log = logger
+    self.__root = root
+    self.__cache_file = os.path.join(ROOT, cache_file)
+    self.__index = None
+    self.__rebuilt = False
+
+  def read_chip(self, chip, keys):
+    """Read many values from the same chip. Returns {key: value}."""
+    path = self.chip_dir(chip)
+    if path is not None:
+      try:
+        return {key: self.__read_file(path, key) for key in keys}
+      except OSError as e:
+        self.__log.warning(f'Failed to read {chip} from {path}. Rebuilding index', exc_info=e)
+        path = self.chip_dir(chip, refresh=True)
+        if path is not None:
+          return {key: self.__read_file(path, key) for key in keys}
+
+    values = self.__read_with_sensors(chip)
+    return {key: values[key] for key in keys}
+
+  def chip_dir(self, chip, refresh=False):
+    """Return the hwmon directory of a chip, or None if it can't be resolved."""
+    if self.__index is None and not refresh:
+      self.__index = self.__load_index()
+    # A miss only justifies rescanning sysfs once per process
+    if refresh or self.__index is None or (chip not in self.__index and not self.__rebuilt):
+      self.__index = self.__build_index()
+      self.__rebuilt = True
+      self.__save_index()
+    return self.__index.get(chip)
+
+  def __read_file(self, path, key):
+    with open(os.path.join(path, key)) as f:
+      raw = int(f.read().strip())
+    scale = self.SCALES.get(key.split('_')[0].rstrip('0123456789'), 1)
+    return f'{raw / scale:.3f}'
+
+  def __read_with_sensors(self, chip):
+    res = run(['sensors', '-u', f'{chip}'], stdout=PIPE,
+              stderr=PIPE, universal_newlines=True, check=True)
+    self.__log.debug(f"Reading sensor: {chip}. Result: {res.stdout}")
+    return {line.split(':')[0].strip(): line.split(':')[1].strip()
+            for line in res.stdout.split('\n') if ':' in line and len(line.split(':')) == 2}
+
+  def __load_index(self):
+    try:
+      with open(self.__cache_file) as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      return None
+    # Make sure the cached directories are hwmon ones, and still belong to
+    # the same chips
+    if not isinstance(index, dict):
+      return None
+    for chip, path in index.items():
+      if not isinstance(path, str) or not self.__in_root(path):
+        return None
+      try:
+        with open(os.path.join(path, 'name')) as f:
+          if not chip.startswith(f.read().strip() + '-'):
+            return None
+      except OSError:
+        return None
+    return index
+
+  def __save_index(self):
+    import tempfile
+    directory, name = os.path.split(self.__cache_file)
+    try:
+      Path(directory).mkdir(parents=True, exist_ok=True)
+      fd, tmp = tempfile.mkstemp(prefix=f'{name}.', dir=directory)
+      try:
+        with os.fdopen(fd, 'w') as f:
+          json.dump(self.__index, f)
+        os.replace(tmp, self.__cache_file)
+      except BaseException:
+        os.unlink(tmp)
+        raise
+    except OSError as e:
+      self.__log.warning(f'Failed to save hwmon index to {self.__cache_file}', exc_info=e)
+
+  def __in_root(self, path):
+    """Whether path is a hwmonN entry of the hwmon root."""
+    directory, entry = os.path.split(os.path.normpath(path))
+    return directory == os.path.normpath(self.__root) and entry.startswith('hwmon')
+
+  def __build_index(self):
+    index = {}
+    try:
+      entries = sorted(os.listdir(self.__root))
+    except OSError as e:
+      self.__log.warning(f'Cannot list {self.__root}', exc_info=e)
+      return index
+    for entry in entries:
+      path = os.path.join(self.__root, entry)
+      try:
+        with open(os.path.join(path, 'name')) as f:
+          name = f.read().strip()
+      except OSError:
+        continue
+      chip = self.__chip_name(name, path)
+      if chip is not None:
+        index[chip] = path
+    self.__log.debug(f'hwmon index: {index}')
+    return index
+
+  @staticmethod
+  def __chip_name(name, path):
+    """Build the lm-sensors name of a chip, e.g. k10temp-pci-00c3."""
+    device = os.path.join(path, 'device')
+    if not os.path.exists(device):
+      return f'{name}-virtual-0'
+    dev_id = os.path.basename(os.path.realpath(device))
+    bus = os.path.basename(os.path.realpath(os.path.join(device, 'subsystem')))
+    try:
+      if bus == 'pci':
+        # 0000:03:00.0 -> domain, bus, slot and function
+        domain, pci_bus, slot_fn = dev_id.split(':')
+        slot, fn = slot_fn.split('.')
+        addr = ((int(domain, 16) << 16) + (int(pci_bus, 16) << 8)
+                + (int(slot, 16) << 3) + int(fn, 16))
+        return f'{name}-pci-{addr:04x}'
+      elif bus in ('isa', 'platform'):
+        # f71869a.2592 -> the base address, in decimal
+        addr = int(dev_id.rsplit('.', 1)[1]) if '.' in dev_id else 0
+        return f'{name}-isa-{addr:04x}'
+      elif bus == 'i2c':
+        # 0-0048 -> adapter and address
+        adapter, addr = dev_id.split('-')
+        return f'{name}-i2c-{int(adapter)}-{int(addr, 16):02x}'
+    except ValueError:
+      pass
+    return None
+
+
 class QhalClient:
   """Client to interact with the daemon."""
 
   def __init__(self, logger):
     """Init."""
     self.__log = logger
+    backend = load_backend()
+    self.__hwmon = HwmonReader(logger, backend.hwmon_root, backend.hwmon_cache)
 
-  def handle_temp_command(self, arg):
+  def handle_temp_command(self, arg, fmt='kv'):
     """Handle temp command."""
     if len(arg) <= 1:
       self.__log.error('Not enough arguments provided for temp command')
-      print('Usage: temp <sensor>')
+      print('Usage: temp <sensor|all>')
+      return
+
+    if arg == 'all':
+      self.print_sensors(self.read_sensors(temps), fmt)
       return
 
     # Arguments
-    sensor = next((s for s in temps if s.name == arg), None)
-    self.__log.info(f"Reading temperature for sensor: {sensor.name}")
+    sensor = hardware.temp.get(arg)
     if sensor is None:
       self.__log.error(f"Unknown sensor: {arg}")
       print(f"Unknown sensor: {arg}")
       return
+    self.__log.info(f"Reading temperature for sensor: {sensor.name}")
 
-    for sensor in temps:
-      if sensor.name == arg and sensor.name == 'CPU':
-        res = self.read_sensor('k10temp-pci-00c3', 'temp1_input')
-        print(f"+{res}°C")
-        return
-      elif sensor.name == arg and sensor.name == 'Eth2':
-        res = self.read_sensor('eth2-pci-0300', 'temp1_input')
-        print(f"+{res}°C")
-        return
-      elif sensor.name == arg and sensor.name == 'Temp1':
-        res = self.read_sensor('f71869a-isa-0a20', 'temp1_input')
-        print(f"+{res}°C")
-        return
-      elif sensor.name == arg and sensor.name == 'Temp2':
-        res = self.read_sensor('f71869a-isa-0a20', 'temp2_input')
-        print(f"+{res}°C")
-        return
-      elif sensor.name == arg and sensor.name == 'Temp3':
-        res = self.read_sensor('f71869a-isa-0a20', 'temp3_input')
-        print(f"+{res}°C")
-        return
-
-    self.__log.error(f"Unsupported sensor: {arg}")
-    print(f"Unsupported sensor: {arg}")
-    return
-
-  def read_sensor(self, chip, key) -> str:
-    """Read sensor."""
-    res = run(['sensors', '-u', f'{chip}'], stdout=PIPE,
-              stderr=PIPE, universal_newlines=True, check=True)
-    self.__log.debug(f"Reading sensor: {chip}. Result: {res.stdout}")
-    res = {line.split(':')[0].strip(): line.split(':')[1].strip()
-           for line in res.stdout.split('\n') if ':' in line and len(line.split(':')) == 2}
-    return res[key]
+    res = self.read_sensors([sensor])[sensor.name]
+    if res is None:
+      print(f"Failed to read sensor: {sensor.name}")
+    else:
+      print(f"+{res:.3f}°C")
 
-  def handle_fan_command(self, arg):
+  def handle_fan_command(self, arg, fmt='kv'):
     """Handle fan command."""
     if len(arg) <= 1:
       self.__log.error('Not enough arguments provided for fan command')
-      print('Usage: fan <fan>')
+      print('Usage: fan <fan|all>')
+      return
+
+    if arg == 'all':
+      self.print_sensors(self.read_sensors(fans), fmt)
       return
 
     # Arguments
-    fan = next((s for s in fans if s.name == arg), None)
-    self.__log.info(f"Reading fan speed for fan: {fan.name}")
+    fan = hardware.fan.get(arg)
     if fan is None:
       self.__log.error(f"Unknown fan: {arg}")
       print(f"Unknown fan: {arg}")
       return
+    self.__log.info(f"Reading fan speed for fan: {fan.name}")
 
-    for sensor in fans:
-      if sensor.name == arg and sensor.name == 'Fan1':
-        res = self.read_sensor('f71869a-isa-0a20', 'fan1_input')
-        print(f"{res.split('.')[0]} RPM")
-        return
-      elif sensor.name == arg and sensor.name == 'Fan2':
-        res = self.read_sensor('f71869a-isa-0a20', 'fan2_input')
-        print(f"{res.split('.')[0]} RPM")
-        return
+    res = self.read_sensors([fan])[fan.name]
+    if res is None:
+      print(f"Failed to read fan: {fan.name}")
+    else:
+      print(f"{int(res)} RPM")
 
-    self.__log.error(f"Unsupported fan: {arg}")
-    print(f"Unsupported fan: {arg}")
-    return
+  def handle_sensors_command(self, fmt='kv'):
+    """Handle sensors command: every temperature and fan at once."""
+    self.print_sensors(self.read_sensors(hardware.sensors), fmt)
+
+  @staticmethod
+  def print_sensors(values, fmt):
+    """Print {name: value} for collectors, as key=value lines or a JSON object."""
+    if fmt == 'json':
+      print(json.dumps(values))
+    else:
+      for name, value in values.items():
+        print(f'{name}={"" if value is None else value}')
+
+  def read_sensors(self, sensors):
+    """Read many sensors, preferring the daemon's samples. Returns {name: value}."""
+    res = self.query_daemon_sensors(sensors)
+    if res is not None:
+      return res
+
+    # Group per chip, so that each chip is read only once
+    chips = {}
+    for sensor in sensors:
+      chips.setdefault(sensor.chip, []).append(sensor)
+    res = {}
+    for chip, members in chips.items():
+      try:
+        values = self.__hwmon.read_chip(chip, [sensor.key for sensor in members])
+      except Exception as e:
+        self.__log.error(f'Failed to read chip {chip}', exc_info=e)
+        values = {}
+      for sensor in members:
+        res[sensor.name] = float(values[sensor.key]) if sensor.key in values else None
+    return {sensor.name: res[sensor.name] for sensor in sensors}
+
+  def query_daemon_sensors(self, sensors):
+    """Return the latest values sampled by the daemon, or None if unavailable."""
+    if not os.path.exists(SOCKET_PATH):
+      return None
+    try:
+      with DaemonConnection(self.__log) as conn:
+        responses = conn.request_many([('sensor', [sensor.name]) for sensor in sensors])
+    except (OSError, ValueError) as e:
+      self.__log.warning('Daemon not available to read sensors', exc_info=e)
+      return None
+    res = {}
+    for sensor, response in zip(sensors, responses):
+      if not response.get('ok') or not isinstance(response.get('result'), dict):
+        self.__log.warning(f'Daemon could not provide {sensor.name}: {response}')
+        return None
+      res[sensor.name] = response['result']['value']
+    return res
 
   def handle_beep_command(self, arg):
     """Handle beep command."""
@@ -508,15 +3226,46 @@ class QhalClient:
       return
 
     # Arguments
-    sound = next((s for s in sounds if s.name == arg), None)
-
-    res = Popen([f"{os.environ['HOME_BIN']}/qnap_hal", 'hal_app', '--se_buzzer',
-                 f"enc_id=0,mode={sound.id}"], stdout=PIPE, stderr=PIPE, cwd=os.getcwd())
-    stdout, stderr = res.communicate()
-    if res.returncode:
-      self.__log.error(f"Failed to play sound: {sound.name}. Return Code:"
-                       f" {res.returncode}. Stderr: {stderr}. Stdout: {stdout}")
+    sound = hardware.sound.get(arg)
+
+    # Let the daemon's buzzer worker play it, if it is running
+    if os.path.exists(SOCKET_PATH):
+      try:
+        with DaemonConnection(self.__log) as conn:
+          response = conn.request('beep', [sound.name])
+        if response.get('ok'):
+          self.__log.info(f"Daemon: {response['result']}")
+          return
+        self.__log.warning(f'Daemon could not play {sound.name}: {response}')
+      except (OSError, ValueError) as e:
+        self.__log.warning('Daemon not available to play sounds', exc_info=e)
+
+    if not play_sound(self.__log, sound):
+      print(f"Failed to play sound: {sound.name}")
+      return False
+    return True
+
+  def handle_ups_command(self, notify_type, ups, message):
+    """Handle ups command. Without the daemon, only the sound of the notification is played."""
+    if os.path.exists(SOCKET_PATH):
+      try:
+        with DaemonConnection(self.__log) as conn:
+          response = conn.request('ups', [notify_type, ups] + message)
+        print(format_response(response))
+        return bool(response.get('ok'))
+      except (OSError, ValueError) as e:
+        self.__log.warning('Daemon not available to handle UPS notifications', exc_info=e)
+
+    action = UPS_ACTIONS.get(notify_type.upper())
+    if action is None or action.sound is None:
+      print(f'UPS {ups}: {notify_type} has no sound, nothing to do without the daemon')
+      return True
+    sound = hardware.sound[action.sound]
+    if not play_sound(self.__log, sound):
       print(f"Failed to play sound: {sound.name}")
+      return False
+    print(f'UPS {ups}: {notify_type} played {sound.name}')
+    return True
 
 
 def lcd_set_state(log, ser, state):
@@ -584,6 +3333,7 @@ def start_daemon(logger):
       print('Daemon started')
   else:
       # Child process
+      import daemon
       with daemon.DaemonContext():
         with open(PID_FILE, 'w') as f:
           f.write(str(os.getpid()))
@@ -625,19 +3375,125 @@ def is_daemon_running(logger):
   return False
 
 
-def send_command_to_daemon(logger, command):
-  """Send a command to the daemon."""
-  logger.info(f"Sending command to daemon: {command}")
-  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+class DaemonConnection:
+  """Persistent connection to the daemon socket.
+
+  Any number of requests can be written before reading the responses back, so
+  a batch of commands costs a single round trip.
+  """
+
+  def __init__(self, logger, path=SOCKET_PATH):
+    """Init."""
+    self.__log = logger
+    self.__next_id = itertools.count(1)
+    self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-      client_socket.connect(SOCKET_PATH)
-      client_socket.sendall(command.encode())
-      response = client_socket.recv(1024).decode()
-      logger.info(f"Response: {response}")
-      print(response)
-    except ConnectionRefusedError as e:
-      logger.error('Could not connect to daemon. Is it running?', exc_info=e)
-      print('No response from daemon. Is it running?')
+      self.__sock.connect(path)
+    except OSError:
+      self.__sock.close()
+      raise
+    self.__reader = self.__sock.makefile('rb')
+
+  def __enter__(self):
+    """Enter."""
+    return self
+
+  def __exit__(self, *_):
+    """Exit."""
+    self.close()
+
+  def close(self):
+    """Close the connection."""
+    self.__reader.close()
+    self.__sock.close()
+
+  def request(self, cmd, args=()):
+    """Send a single command and wait for its response."""
+    return self.request_many([(cmd, args)])[0]
+
+  def request_many(self, commands):
+    """Pipeline (cmd, args) tuples and return their responses, in order."""
+    requests = [{'id': next(self.__next_id), 'cmd': cmd, 'args': list(args)}
+                for cmd, args in commands]
+    self.__sock.sendall(b''.join(json.dumps(r).encode() + b'\n' for r in requests))
+
+    responses = {}
+    while len(responses) < len(requests):
+      line = self.__reader.readline()
+      if not line:
+        raise ConnectionError('Daemon closed the connection')
+      response = json.loads(line.decode())
+      responses[response.get('id')] = response
+    return [responses.get(r['id'], {'ok': False, 'error': 'Missing response'})
+            for r in requests]
+
+  def events(self, filters=()):
+    """Subscribe to daemon events and yield them as they come, forever."""
+    response = self.request('subscribe', filters)
+    if not response.get('ok'):
+      raise ValueError(response.get('error', 'Unknown error'))
+    while True:
+      line = self.__reader.readline()
+      if not line:
+        raise ConnectionError('Daemon closed the connection')
+      event = json.loads(line.decode())
+      if 'event' in event:
+        yield event
+
+
+def format_response(response):
+  """Render a daemon response for the terminal."""
+  if not response.get('ok'):
+    return response.get('error', 'Unknown error')
+  result = response.get('result')
+  if isinstance(result, str):
+    return result
+  return json.dumps(result)
+
+
+def send_command_to_daemon(logger, cmd, args=()):
+  """Send a command to the daemon. Returns whether it succeeded."""
+  return send_commands_to_daemon(logger, [(cmd, args)])
+
+
+def send_commands_to_daemon(logger, commands):
+  """Send a batch of commands to the daemon, in a single round trip.
+
+  Returns whether the daemon answered and all the commands succeeded.
+  """
+  logger.info(f"Sending commands to daemon: {commands}")
+  ok = True
+  try:
+    with DaemonConnection(logger) as conn:
+      for response in conn.request_many(commands):
+        logger.info(f"Response: {response}")
+        print(format_response(response))
+        ok = ok and bool(response.get('ok'))
+  except (FileNotFoundError, ConnectionRefusedError) as e:
+    logger.error('Could not connect to daemon. Is it running?', exc_info=e)
+    print('No response from daemon. Is it running?')
+    return False
+  return ok
+
+
+def subscribe_daemon(logger, filters):
+  """Print daemon events as newline-delimited JSON, until interrupted. Returns False on errors."""
+  logger.info(f'Subscribing to daemon events: {filters}')
+  try:
+    with DaemonConnection(logger) as conn:
+      for event in conn.events(filters):
+        print(json.dumps(event), flush=True)
+  except (FileNotFoundError, ConnectionRefusedError) as e:
+    logger.error('Could not connect to daemon. Is it running?', exc_info=e)
+    print('No response from daemon. Is it running?')
+    return False
+  except ValueError as e:
+    print(e)
+    return False
+  except ConnectionError as e:
+    logger.info(f'Subscription ended: {e}')
+  except (KeyboardInterrupt, BrokenPipeError):
+    pass
 
 
 def status_daemon(logger):
@@ -649,8 +3505,25 @@ def status_daemon(logger):
 
 
 def load_config(logger):
-  """Load project configuration."""
+  """Load project configuration.
+
+  Resolving @GIT_ROOT@ and parsing the file is slow, so the resulting values
+  are cached in CONFIG_CACHE until local.env is modified.
+  """
   filename = f"{ROOT}/data/local.env"
+  cache_file = f"{ROOT}/{CONFIG_CACHE}"
+  stat = os.stat(filename)
+  key = [filename, stat.st_mtime_ns, stat.st_size]
+  try:
+    with open(cache_file) as file:
+      cache = json.load(file)
+    if cache['key'] == key:
+      os.environ.update(cache['values'])
+      return
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+
+  from dotenv import dotenv_values
   # Need to load file in memory to perform text replace
   with open(filename) as file:
     data = file.read()
@@ -660,7 +3533,18 @@ def load_config(logger):
       data = data.replace('@GIT_ROOT@', git_root)
 
     # Load the configuration
-    load_dotenv(stream=io.StringIO(data), override=True)
+    values = {name: value for name, value in dotenv_values(stream=io.StringIO(data)).items()
+              if value is not None}
+    os.environ.update(values)
+
+  try:
+    Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as file:
+      json.dump({'key': key, 'values': values}, file)
+    os.replace(tmp_file, cache_file)
+  except OSError as e:
+    logger.warning(f'Could not cache the configuration in {cache_file}', exc_info=e)
 
   # TODO: Support encrypted files
   # all_config_files = os.environ['LOCAL_CONFIG']
@@ -683,21 +3567,17 @@ def get_git_root(logger):
   # Ok, from this point we have a valid directory
   logger.info('Starting search for git root, starting from: %s', cur_dir)
   # Check if git is installed
-  if run(['command', '-v', 'git'], stdout=DEVNULL, stderr=DEVNULL).returncode != 0:
+  import shutil
+  if shutil.which('git') is None:
       raise Exception('Git not installed')
 
-  if run(['git', 'rev-parse', '--is-inside-work-tree'], cwd=cur_dir,
-         stdout=DEVNULL, stderr=DEVNULL).returncode == 0:
-    res = run(['git', 'rev-parse', '--show-toplevel'], cwd=cur_dir,
-              stdout=PIPE, stderr=PIPE, check=True)
-    cur_dir = res.stdout.decode().strip()
-    next_dir = os.path.dirname(cur_dir)
-    while run(['git', 'rev-parse', '--is-inside-work-tree'], cwd=next_dir,
-              stdout=DEVNULL, stderr=DEVNULL).returncode == 0:
-      res = run(['git', 'rev-parse', '--show-toplevel'], cwd=next_dir,
-                stdout=PIPE, stderr=PIPE, check=True)
+  # --show-toplevel fails outside of a work tree, so one call per level is enough
+  res = run(['git', 'rev-parse', '--show-toplevel'], cwd=cur_dir, stdout=PIPE, stderr=DEVNULL)
+  if res.returncode == 0:
+    while res.returncode == 0:
       cur_dir = res.stdout.decode().strip()
-      next_dir = os.path.dirname(cur_dir)
+      res = run(['git', 'rev-parse', '--show-toplevel'], cwd=os.path.dirname(cur_dir),
+                stdout=PIPE, stderr=DEVNULL)
     logger.info('Found git root: %s', cur_dir)
   else:
     logger.warning('Not a git repository: %s', cur_dir)
@@ -707,20 +3587,48 @@ def get_git_root(logger):
 
 def handle_lcd_command(logger, args):
   """Handle the LCD command."""
+  if args.lcd_command is None:
+    print('Usage: lcd <on|off|write>')
+    return
+
+  # The daemon keeps the panel open and only sends what changed
+  if os.path.exists(SOCKET_PATH):
+    lcd_args = [args.lcd_command]
+    if args.lcd_command == 'write':
+      lcd_args += [args.line1, args.line2]
+    try:
+      with DaemonConnection(logger) as conn:
+        response = conn.request('lcd', lcd_args)
+      if response.get('ok'):
+        print(format_response(response))
+        return
+      logger.warning(f'Daemon could not drive the LCD: {response}')
+    except (OSError, ValueError) as e:
+      logger.warning('Daemon not available to drive the LCD', exc_info=e)
+
   try:
-    with Serial(port='/dev/ttyS1', baudrate=1200, timeout=1) as ser:
+    with load_backend().serial(LCD_PORT, LCD_BAUDRATE, 1) as ser:
       if args.lcd_command == 'on' or args.lcd_command == 'off':
         lcd_set_state(logger, ser, args.lcd_command)
       elif args.lcd_command == 'write':
         lcd_write(logger, ser, args.line1, args.line2)
   except Exception as e:
-    logger.error('Failed to open serial port: /dev/ttyS1', exc_info=e)
+    logger.error(f'Failed to open serial port: {LCD_PORT}', exc_info=e)
+
+
+def read_batch(stream):
+  """Parse one command per line, shell style. Blank lines and comments are skipped."""
+  commands = []
+  for line in stream:
+    words = shlex.split(line, comments=True)
+    if words:
+      commands.append((words[0], words[1:]))
+  return commands
 
 
 def process_command(logger, args):
-  """Process the command."""
+  """Process the command. Returns False if it failed."""
   client = QhalClient(logger)
-  cmd = f"{' '.join(str(v) for v in vars(args).values() if v is not None)}"
   logger.info(f"Received a valid command: {args}")
   if args.command == 'start':
     start_daemon(logger)
@@ -729,33 +3637,78 @@ def process_command(logger, args):
   elif args.command == 'status':
     status_daemon(logger)
   elif args.command == 'beep':
-    client.handle_beep_command(args.sound)
+    return client.handle_beep_command(args.sound)
   elif args.command == 'temp':
-    client.handle_temp_command(args.sensor)
+    client.handle_temp_command(args.sensor, args.format)
   elif args.command == 'fan':
-    client.handle_fan_command(args.fan)
+    client.handle_fan_command(args.fan, args.format)
+  elif args.command == 'sensors':
+    client.handle_sensors_command(args.format)
   elif args.command == 'lcd':
     handle_lcd_command(logger, args)
-  else:
-    send_command_to_daemon(logger, cmd)
+  elif args.command == 'batch':
+    return send_commands_to_daemon(logger, read_batch(args.file))
+  elif args.command == 'led':
+    return send_command_to_daemon(logger, 'led',
+                                  [v for v in (args.name, args.state) if v is not None]
+                                  + args.pattern_args)
+  elif args.command == 'button':
+    return send_command_to_daemon(logger, 'button', [args.name] + args.to_execute)
+  elif args.command == 'test':
+    return send_command_to_daemon(logger, 'test', [args.mode])
+  elif args.command == 'stats':
+    return send_command_to_daemon(logger, 'stats')
+  elif args.command == 'smart':
+    return send_command_to_daemon(logger, 'smart', [args.device])
+  elif args.command == 'raid':
+    return send_command_to_daemon(logger, 'raid', [args.array] if args.array else [])
+  elif args.command == 'ups':
+    return client.handle_ups_command(args.type, args.ups, args.message)
+  elif args.command == 'alerts':
+    return send_command_to_daemon(logger, 'alerts')
+  elif args.command == 'fanctl':
+    return send_command_to_daemon(logger, 'fanctl', [args.mode] if args.mode else [])
+  elif args.command == 'subscribe':
+    return subscribe_daemon(logger, args.filters)
+  elif args.command == 'sim':
+    return send_command_to_daemon(logger, 'sim', args.sim_args)
+  elif args.command == 'jobs':
+    return send_command_to_daemon(logger, 'jobs')
+  elif args.command == 'sensor':
+    return send_command_to_daemon(logger, 'sensor',
+                                  [str(v) for v in (args.name, args.query, args.window)
+                                   if v is not None])
 
 
 def main():
-  """Start execution here."""
-  logger = LoggerConfig().get_logger()
+  """Start execution here. Returns the exit status."""
+  if sys.argv[1:2] == [FAN_WATCHDOG]:
+    fan_watchdog(sys.argv[2:])
+  # Client runs of the day share one log file
+  logger = LoggerConfig(stamp='%F').get_logger()
   load_config(logger)
   try:
     logger.info('== %s Started ==', Path(__file__).name)
 
     args = parse()
-    if args is not None:
-      process_command(logger, args)
+    startup = time.monotonic() - STARTED
+    if startup > STARTUP_BUDGET:
+      logger.warning(f'Startup took {startup * 1000:.1f} ms,'
+                     f' over the {STARTUP_BUDGET * 1000:.0f} ms budget')
     else:
+      logger.debug(f'Startup took {startup * 1000:.1f} ms')
+    if args is None:
       logger.error('No arguments provided')
+      return 1
+    if process_command(logger, args) is False:
+      logger.info('== %s Exited with an error ==', Path(__file__).name)
+      return 1
 
     logger.info('== %s Exited gracefully ==', Path(__file__).name)
   except Exception as e:
     logger.critical('== %s Failed ==', Path(__file__).name, exc_info=e)
+    return 1
+  return 0
 
 
 def parse():
@@ -771,28 +3724,92 @@ def parse():
   subparsers.add_parser('status', help='Check the status of the daemon')
 
   beep_parser = subparsers.add_parser('beep', help='Execute beep command')
-  beep_parser.add_argument('sound', choices=[s.name for s in sounds], help='Sound to play')
+  beep_parser.add_argument('sound', choices=list(hardware.sound), help='Sound to play')
 
-  led_parser = subparsers.add_parser('led', help='Set LED state')
-  led_parser.add_argument('name', choices=[led.name for led in leds], help='LED name')
-  led_parser.add_argument('state', choices=['on', 'off'], nargs='?', help='LED state')
+  led_parser = subparsers.add_parser('led', help='Set LED state or pattern')
+  led_parser.add_argument('name', choices=list(hardware.led), help='LED name')
+  led_parser.add_argument('state', choices=['on', 'off', 'auto'] + list(LED_PATTERNS),
+                          nargs='?',
+                          help='LED state, auto to give it back to the daemon, or pattern to'
+                               ' play: blink [hz], heartbeat, pulse [ms], duty <period_s>'
+                               ' <percent>')
+  led_parser.add_argument('pattern_args', nargs='*', help='Pattern arguments')
 
   button_parser = subparsers.add_parser('button', help='Set button command')
   button_parser.add_argument('name',
-                             choices=[button.name for button in buttons], help='Button name')
+                             choices=list(hardware.button), help='Button name')
   button_parser.add_argument('to_execute',
                              nargs=argparse.REMAINDER,
-                             help='Command to execute when the button is pressed')
+                             help='Command to execute when the button is pressed,'
+                                  ' optionally preceded by the gesture triggering it:'
+                                  ' [short|long|double] -- <command> (Default: short)')
 
-  temp_parser = subparsers.add_parser('temp', help='Read temperature')
-  temp_parser.add_argument('sensor', choices=[temp.name for temp in temps], help='Sensor to read')
+  format_parser = argparse.ArgumentParser(add_help=False)
+  format_parser.add_argument('--format', choices=['kv', 'json'], default='kv',
+                             help='Output format when reading many sensors (Default: kv)')
 
-  fan_parser = subparsers.add_parser('fan', help='Read fan speed')
-  fan_parser.add_argument('fan', choices=[fan.name for fan in fans], help='Fan to read')
+  temp_parser = subparsers.add_parser('temp', help='Read temperature', parents=[format_parser])
+  temp_parser.add_argument('sensor', choices=['all'] + list(hardware.temp),
+                           help='Sensor to read')
+
+  fan_parser = subparsers.add_parser('fan', help='Read fan speed', parents=[format_parser])
+  fan_parser.add_argument('fan', choices=['all'] + list(hardware.fan), help='Fan to read')
+
+  subparsers.add_parser('sensors', help='Read all temperatures and fans at once',
+                        parents=[format_parser])
 
   test_parser = subparsers.add_parser('test', help='Test Mode (Christmas Tree)')
   test_parser.add_argument('mode', choices=['on', 'off'], help='Test mode')
 
+  subparsers.add_parser('jobs', help='List the running and finished button commands')
+
+  smart_parser = subparsers.add_parser('smart', help='Show the SMART data cached by the daemon')
+  smart_parser.add_argument('device', nargs='?', default='all',
+                            help='Drive to show such as sda, all of them, or refresh to read'
+                                 ' them again now (Default: all)')
+
+  raid_parser = subparsers.add_parser('raid', help='Show the md RAID arrays and their resync')
+  raid_parser.add_argument('array', nargs='?', help='Array to show, such as md0 (Default: all)')
+
+  ups_parser = subparsers.add_parser('ups', help='Handle a UPS notification from NUT')
+  ups_parser.add_argument('type', help='NOTIFYTYPE of the notification, such as ONBATT')
+  ups_parser.add_argument('ups', help='UPSNAME of the notification')
+  ups_parser.add_argument('message', nargs='*', help='Message of the notification')
+
+  subparsers.add_parser('alerts', help='Show the alert rules and their state')
+
+  fanctl_parser = subparsers.add_parser('fanctl', help='Fan control by the daemon')
+  fanctl_parser.add_argument('mode', choices=['on', 'off'], nargs='?',
+                             help='Take control of the fans, or give it back to the hardware'
+                                  ' (Default: show the state of the control)')
+
+  subparsers.add_parser('stats', help='Show the counters and latencies measured by the daemon')
+
+  subscribe_parser = subparsers.add_parser('subscribe',
+                                           help='Print daemon events as they happen,'
+                                                ' one JSON object per line')
+  subscribe_parser.add_argument('filters', nargs='*',
+                                help=f"Events to receive: a kind ({', '.join(EVENT_KINDS)}),"
+                                     ' or a kind and a name such as led:Status_Red'
+                                     ' (Default: everything)')
+
+  sim_parser = subparsers.add_parser('sim', help='Drive the simulated hardware (QHAL_BACKEND=sim)')
+  sim_parser.add_argument('sim_args', nargs=argparse.REMAINDER,
+                          help='press <button> [seconds] | set <sensor> <value> | show')
+
+  sensor_parser = subparsers.add_parser('sensor', help='Query sensor history kept by the daemon')
+  sensor_parser.add_argument('name', choices=['all'] + list(hardware.sensor),
+                             help='Sensor to query')
+  sensor_parser.add_argument('query', choices=['latest', 'stats', 'series'], nargs='?',
+                             help='Latest value, min/max/avg or raw samples (Default: latest)')
+  sensor_parser.add_argument('window', type=float, nargs='?',
+                             help='Window in seconds for stats and series')
+
+  batch_parser = subparsers.add_parser('batch', help='Send many daemon commands at once')
+  batch_parser.add_argument('file', nargs='?', type=argparse.FileType('r'), default='-',
+                            help='File with one command per line, such as "led Status_Red on"'
+                                 ' (Default: stdin)')
+
   # LCD commands
   lcd_parser = subparsers.add_parser('lcd', help='Control the LCD panel')
   lcd_subparsers = lcd_parser.add_subparsers(dest='lcd_command', help='LCD command')
@@ -813,12 +3830,27 @@ def parse():
 
 
 class LoggerConfig:
-  """Logger configuration."""
-
-  def __init__(self, name=Path(__file__).stem):
-    """Configure the root logger."""
-    self.__filename = f'{ROOT}/.log/{name}_' \
-                      f'{datetime.now().strftime("%F_%H%M%S")}.log'
+  """Logger configuration.
+
+  With background=True, as used by the daemon, records are only queued by the
+  logging thread and written by a listener thread, to a file rotated once it
+  reaches LOG_MAX_BYTES. It also removes the log files of this program older
+  than LOG_RETENTION_DAYS, which the short-lived clients don't bother with.
+  """
+
+  def __init__(self, name=Path(__file__).stem, stamp='%F_%H%M%S', background=False):
+    """Configure the root logger.
+
+    The log file is named after the time formatted with stamp, and only
+    created once something is logged. Background loggers use a fixed name,
+    since they are rotated.
+    """
+    import logging.handlers
+    if background:
+      self.__filename = f'{ROOT}/.log/{name}.log'
+    else:
+      self.__filename = f'{ROOT}/.log/{name}_' \
+                        f'{datetime.now().strftime(stamp)}.log'
     Path(self.__filename).parent.mkdir(parents=True, exist_ok=True)
 
     level = logging.DEBUG  # Default value
@@ -832,38 +3864,85 @@ class LoggerConfig:
     self.__console.setLevel(level)
     self.__console.setFormatter(logging.Formatter(format, datefmt))
 
-    self.__file = logging.FileHandler(filename=self.__filename, encoding='utf-8', mode='a+')
+    if background:
+      self.__file = logging.handlers.RotatingFileHandler(
+        filename=self.__filename, encoding='utf-8', mode='a+', delay=True,
+        maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    else:
+      self.__file = logging.FileHandler(filename=self.__filename, encoding='utf-8', mode='a+',
+                                        delay=True)
     self.__file.setLevel(level)
     self.__file.setFormatter(logging.Formatter(format, datefmt))
 
-    # self.__logger.addHandler(self.__console)
-    self.__logger.addHandler(self.__file)
+    self.__listener = None
+    if background:
+      self.__listener = logging.handlers.QueueListener(
+        queue.Queue(), self.__file, respect_handler_level=True)
+      self.__logger.addHandler(logging.handlers.QueueHandler(self.__listener.queue))
+      self.__listener.start()
+    else:
+      # self.__logger.addHandler(self.__console)
+      self.__logger.addHandler(self.__file)
 
     self.reconfigure()
+    if background:
+      self.__prune()
 
   # Levels as defined by logger-shell
-  def _set_level(self, level):
+  def _set_level(self, value):
     level = logging.NOTSET
 
-    if level == 3:
+    if value == 3:
       level = logging.DEBUG
-    elif level == 4:
+    elif value == 4:
       level = logging.INFO
-    elif level == 5:
+    elif value == 5:
       level = logging.WARNING
-    elif level == 6:
+    elif value == 6:
       level = logging.ERROR
-    elif level == 7:
+    elif value == 7:
       level = logging.CRITICAL
 
     self.__logger.setLevel(level)
     self.__console.setLevel(level)
     self.__file.setLevel(level)
 
+  def __set_console(self, enabled):
+    if self.__listener is None:
+      handlers = list(self.__logger.handlers)
+    else:
+      handlers = list(self.__listener.handlers)
+    if enabled and self.__console not in handlers:
+      handlers.append(self.__console)
+    elif not enabled and self.__console in handlers:
+      handlers.remove(self.__console)
+
+    if self.__listener is None:
+      self.__logger.handlers = handlers
+    else:
+      self.__listener.handlers = tuple(handlers)
+
+  def __prune(self):
+    # Daemon and client logs alike, rotated files included
+    limit = time.time() - LOG_RETENTION_DAYS * 86400
+    for path in Path(self.__filename).parent.glob(f'{Path(__file__).stem}_*'):
+      try:
+        if path != Path(self.__filename) and path.stat().st_mtime < limit:
+          path.unlink()
+      except OSError as e:
+        self.__logger.warning(f'Could not remove old log file {path}', exc_info=e)
+
   def get_logger(self):
     """Return the logger."""
     return self.__logger
 
+  def close(self):
+    """Write the records still queued, and stop the listener thread."""
+    if self.__listener is not None:
+      self.__listener.stop()
+      self.__listener = None
+    self.__file.close()
+
   def reconfigure(self):
     """Force a reconfiguration of the logger."""
     if 'LOG_LEVEL' in os.environ:
@@ -871,16 +3950,13 @@ class LoggerConfig:
       self._set_level(level)
 
       if 'LOG_CONSOLE' in os.environ:
-        if int(os.environ['LOG_CONSOLE']) == 0:
-          self.__logger.removeHandler(self.__console)
-        else:
-          self.__logger.addHandler(self.__console)
+        self.__set_console(int(os.environ['LOG_CONSOLE']) != 0)
 
 
 # Get ROOT
 ROOT = os.path.realpath(os.path.dirname(os.path.realpath(os.path.abspath(__file__))) + '/../..')
 
 if __name__ == '__main__':
-  main()
+  sys.exit(main())
 else:
   raise Exception(f"{__file__} is not a library")
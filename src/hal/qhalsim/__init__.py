@@ -0,0 +1,370 @@
+# SPDX-License-Identifier: MIT
+
+"""Simulated QNAP hardware, so the qhal daemon can run on any Linux machine.
+
+Selected by running qhal with QHAL_BACKEND=sim. The simulator models the
+F71869A index/data registers, the buttons wired to them, the front panel LCD
+at the end of its serial line, and the hwmon sysfs tree of the sensors. The
+state is shared through QHAL_SIM_DIR, so clients read the same sensors as the
+daemon.
+"""
+
+import os
+import threading
+import time
+
+# The F71869A GPIO registers are reached through this index/data port pair
+INDEX_PORT = 0xa05
+DATA_PORT = 0xa06
+
+SIM_DIR = os.environ.get('QHAL_SIM_DIR', '/tmp/qhal_sim')
+
+# How long a simulated button press lasts by default, in seconds
+PRESS_DURATION = 0.1
+
+
+class SuperIOSim:
+  """The SuperIO registers, reached through the index and data ports.
+
+  Registers read 0xff until written: LEDs are active-low, so they start off.
+  Input bits ignore writes and read high, unless a press pulls them low.
+  """
+
+  def __init__(self, inputs):
+    """Init."""
+    self.__lock = threading.Lock()
+    self.__index = 0
+    self.__registers = {}
+    self.__inputs = {}
+    for port, bit in inputs:
+      self.__inputs[port] = self.__inputs.get(port, 0) | (1 << bit)
+    # {(port, bit): monotonic time of the release}
+    self.__pressed = {}
+
+  def inb(self, port):
+    """Read an I/O port."""
+    if port != DATA_PORT:
+      return 0xff
+    with self.__lock:
+      return self.__read(self.__index)
+
+  def outb(self, value, port):
+    """Write an I/O port."""
+    with self.__lock:
+      if port == INDEX_PORT:
+        self.__index = value & 0xff
+      elif port == DATA_PORT:
+        inputs = self.__inputs.get(self.__index, 0)
+        old = self.__registers.get(self.__index, 0xff)
+        self.__registers[self.__index] = (old & inputs) | (value & ~inputs & 0xff)
+
+  def register(self, port):
+    """Return the value a register would read."""
+    with self.__lock:
+      return self.__read(port)
+
+  def press(self, port, bit, duration=PRESS_DURATION):
+    """Hold an input bit low for duration seconds."""
+    with self.__lock:
+      self.__pressed[(port, bit)] = time.monotonic() + duration
+
+  def __read(self, port):
+    value = self.__registers.get(port, 0xff)
+    now = time.monotonic()
+    for (pressed_port, bit), until in list(self.__pressed.items()):
+      if until <= now:
+        del self.__pressed[(pressed_port, bit)]
+      elif pressed_port == port:
+        value &= ~(1 << bit)
+    return value
+
+
+class LcdSim:
+  """The front panel LCD, as seen through its serial port.
+
+  Writes return at once, like they do on a real port, but every byte takes
+  the 10 bits of time it needs at the configured baud rate to reach the panel.
+  Each command is answered once it is fully received: queries with their
+  report, everything else with an ACK.
+  """
+
+  # Answers to the queries, by command byte
+  REPORTS = {
+    0x00: bytes([0x53, 0x01, 0x00, 0x01]),  # Report_ID
+    0x06: bytes([0x53, 0x05, 0x00, 0x00]),  # Switch_Status
+    0x07: bytes([0x53, 0x08, 0x00, 0x01]),  # Protocol_Version
+    0xff: bytes([0x53, 0xaa]),  # Reset_OK
+  }
+  ACK = bytes([0x53, 0xfa])
+
+  def __init__(self, baudrate, timeout, rows=2, columns=16):
+    """Init."""
+    self.__byte_time = 10 / baudrate
+    self.timeout = timeout
+    self.is_open = True
+    self.rows = [' ' * columns for _ in range(rows)]
+    self.backlight = False
+    self.__lock = threading.Condition()
+    self.__received = bytearray()
+    self.__busy_until = 0.0
+    # [(monotonic time the bytes are available, bytes)]
+    self.__answers = []
+
+  def __enter__(self):
+    """Enter."""
+    return self
+
+  def __exit__(self, *_):
+    """Close the port."""
+    self.close()
+
+  def close(self):
+    """Close the port."""
+    self.is_open = False
+
+  @property
+  def out_waiting(self):
+    """Bytes written but not yet transmitted."""
+    with self.__lock:
+      return max(0, round((self.__busy_until - time.monotonic()) / self.__byte_time))
+
+  @property
+  def in_waiting(self):
+    """Bytes ready to be read."""
+    with self.__lock:
+      now = time.monotonic()
+      return sum(len(data) for at, data in self.__answers if at <= now)
+
+  def write(self, data):
+    """Queue data for transmission. Returns the number of bytes written."""
+    if not self.is_open:
+      raise OSError('Port is closed')
+    with self.__lock:
+      start = max(self.__busy_until, time.monotonic())
+      for n, byte in enumerate(bytes(data), 1):
+        self.__received.append(byte)
+        answer = self.__parse()
+        if answer:
+          self.__answers.append((start + n * self.__byte_time, answer))
+      self.__busy_until = start + len(data) * self.__byte_time
+      self.__lock.notify_all()
+    return len(data)
+
+  def flush(self):
+    """Wait until everything written has been transmitted."""
+    delay = self.out_waiting * self.__byte_time
+    if delay > 0:
+      time.sleep(delay)
+
+  def read(self, size=1):
+    """Read up to size bytes, waiting up to the timeout for them."""
+    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+    res = bytearray()
+    with self.__lock:
+      while True:
+        now = time.monotonic()
+        while self.__answers and self.__answers[0][0] <= now and len(res) < size:
+          at, data = self.__answers.pop(0)
+          take = size - len(res)
+          res += data[:take]
+          if data[take:]:
+            self.__answers.insert(0, (at, data[take:]))
+        if len(res) >= size or (deadline is not None and now >= deadline):
+          return bytes(res)
+        wake = [at for at, _ in self.__answers[:1]]
+        if deadline is not None:
+          wake.append(deadline)
+        self.__lock.wait(max(0, min(wake) - now) if wake else None)
+
+  def __parse(self):
+    # Returns the answer to the command completed by the last byte, if any
+    buf = self.__received
+    if buf[0] != 0x4d:
+      del buf[0]
+      return None
+    if len(buf) < 2:
+      return None
+    cmd = buf[1]
+    if cmd == 0x0c:
+      if len(buf) < 4 or len(buf) < 4 + buf[3]:
+        return None
+      row, length = buf[2], buf[3]
+      text = bytes(buf[4:4 + length]).decode('ascii', 'replace')
+      if row < len(self.rows):
+        columns = len(self.rows[row])
+        self.rows[row] = text.ljust(columns)[:columns]
+      del buf[:4 + length]
+    elif cmd == 0x5e:
+      if len(buf) < 3:
+        return None
+      self.backlight = bool(buf[2])
+      del buf[:3]
+    else:
+      del buf[:2]
+    return self.REPORTS.get(cmd, self.ACK)
+
+
+def chip_device(chip):
+  """Return the (sysfs device directory, bus) of an lm-sensors chip name, or None.
+
+  This is the reverse of the naming done by qhal's HwmonReader.
+  """
+  name, bus, addr = chip.split('-', 2)
+  if bus == 'pci':
+    addr = int(addr, 16)
+    dev_id = f'{addr >> 16:04x}:{(addr >> 8) & 0xff:02x}:{(addr >> 3) & 0x1f:02x}.{addr & 7}'
+    return f'devices/pci0000:00/{dev_id}', 'pci'
+  elif bus == 'isa':
+    return f'devices/isa/{name}.{int(addr, 16)}', 'isa'
+  elif bus == 'i2c':
+    adapter, addr = addr.split('-')
+    return f'devices/i2c-{adapter}/{adapter}-{int(addr, 16):04x}', 'i2c'
+  return None
+
+
+class HwmonSim:
+  """A fake /sys tree holding hwmon directories for the given sensors.
+
+  Temperatures start at 40 degrees and fans at 1500 RPM. Each fan comes with
+  the PWM attributes of the f71882fg driver, in automatic mode. The tree is
+  only created when it doesn't exist yet, so values set by one process are
+  seen by the others.
+  """
+
+  # Scale between the values set and the sysfs units
+  SCALES = {'temp': 1000, 'in': 1000, 'curr': 1000, 'power': 1000000, 'energy': 1000000}
+  DEFAULTS = {'temp': 40.0, 'fan': 1500.0}
+
+  def __init__(self, directory, sensors):
+    """Init."""
+    self.root = os.path.join(directory, 'class', 'hwmon')
+    self.__directory = directory
+    self.__paths = {}
+    self.__pwms = {}
+    chips = []
+    for sensor in sensors:
+      if sensor.chip not in chips:
+        chips.append(sensor.chip)
+      hwmon = os.path.join(self.root, f'hwmon{chips.index(sensor.chip)}')
+      self.__paths[sensor.name] = os.path.join(hwmon, sensor.key)
+      if not os.path.exists(self.__paths[sensor.name]):
+        self.__create(hwmon, sensor.chip)
+        kind = self.__kind(sensor.key)
+        self.set(sensor.name, self.DEFAULTS.get(kind, 0.0))
+      if self.__kind(sensor.key) == 'fan':
+        pwm = os.path.join(hwmon, sensor.key.split('_')[0].replace('fan', 'pwm'))
+        self.__pwms[sensor.name] = pwm
+        for path, value in ((pwm, 128), (f'{pwm}_enable', 2)):
+          if not os.path.exists(path):
+            with open(path, 'w') as f:
+              f.write(f'{value}\n')
+
+  def set(self, name, value):
+    """Set the value of a sensor, in the units of `sensors -u`."""
+    path = self.__paths[name]
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+      f.write(f'{round(value * self.SCALES.get(self.__kind(os.path.basename(path)), 1))}\n')
+    os.replace(tmp, path)
+
+  def get(self, name):
+    """Get the value of a sensor, in the units of `sensors -u`."""
+    path = self.__paths[name]
+    with open(path) as f:
+      return int(f.read()) / self.SCALES.get(self.__kind(os.path.basename(path)), 1)
+
+  def names(self):
+    """Names of the sensors."""
+    return list(self.__paths)
+
+  def pwms(self):
+    """PWM duty (0-255) and mode of each fan."""
+    res = {}
+    for name, path in self.__pwms.items():
+      with open(path) as f, open(f'{path}_enable') as enable:
+        res[name] = {'pwm': int(f.read()), 'enable': int(enable.read())}
+    return res
+
+  @staticmethod
+  def __kind(key):
+    return key.split('_')[0].rstrip('0123456789')
+
+  def __create(self, hwmon, chip):
+    os.makedirs(hwmon, exist_ok=True)
+    with open(os.path.join(hwmon, 'name'), 'w') as f:
+      f.write(chip.split('-')[0] + '\n')
+    device = chip_device(chip)
+    link = os.path.join(hwmon, 'device')
+    if device is None or os.path.lexists(link):
+      return
+    path, bus = device
+    device_dir = os.path.join(self.__directory, path)
+    bus_dir = os.path.join(self.__directory, 'bus', bus)
+    os.makedirs(device_dir, exist_ok=True)
+    os.makedirs(bus_dir, exist_ok=True)
+    if not os.path.lexists(os.path.join(device_dir, 'subsystem')):
+      os.symlink(bus_dir, os.path.join(device_dir, 'subsystem'))
+    os.symlink(device_dir, link)
+
+
+class SimBackend:
+  """Hardware backend of qhal, backed by the simulators above."""
+
+  def __init__(self, leds, buttons, sensors, directory=SIM_DIR):
+    """Init."""
+    self.__leds = leds
+    self.__buttons = buttons
+    self.__superio = SuperIOSim([(button.port, button.bit) for button in buttons])
+    self.__hwmon = HwmonSim(directory, sensors)
+    self.__lcds = {}
+    self.hwmon_root = self.__hwmon.root
+    self.hwmon_cache = os.path.join(directory, 'hwmon.json')
+
+  def ioperm(self, port, count, enable):
+    """Get or release access to count I/O ports. Always succeeds."""
+    return 0
+
+  def ports(self):
+    """Return the (inb, outb) functions."""
+    return self.__superio.inb, self.__superio.outb
+
+  def serial(self, port, baudrate, timeout):
+    """Open a serial port, with the LCD at the other end."""
+    lcd = LcdSim(baudrate, timeout)
+    self.__lcds[port] = lcd
+    return lcd
+
+  def command(self, args):
+    """Command."""
+    usage = 'Usage: sim <press <button> [seconds]|set <sensor> <value>|show>'
+    if not args:
+      return usage
+    if args[0] == 'press' and len(args) in (2, 3):
+      button = next((b for b in self.__buttons if b.name == args[1]), None)
+      if button is None:
+        return f'Unknown button: {args[1]}'
+      try:
+        duration = float(args[2]) if len(args) == 3 else PRESS_DURATION
+      except ValueError:
+        return usage
+      self.__superio.press(button.port, button.bit, duration)
+      return f'Button {button.name} pressed for {duration}s'
+    elif args[0] == 'set' and len(args) == 3:
+      if args[1] not in self.__hwmon.names():
+        return f'Unknown sensor: {args[1]}'
+      try:
+        self.__hwmon.set(args[1], float(args[2]))
+      except ValueError:
+        return usage
+      return f'Sensor {args[1]} set to {args[2]}'
+    elif args[0] == 'show' and len(args) == 1:
+      return {
+        'leds': {led.name: 'off' if self.__superio.register(led.port) & (1 << led.bit) else 'on'
+                 for led in self.__leds},
+        'lcd': {port: {'backlight': lcd.backlight, 'rows': lcd.rows,
+                       'out_waiting': lcd.out_waiting}
+                for port, lcd in self.__lcds.items()},
+        'sensors': {name: self.__hwmon.get(name) for name in self.__hwmon.names()},
+        'fans': self.__hwmon.pwms(),
+      }
+    return usage
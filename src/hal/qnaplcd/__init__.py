@@ -2,6 +2,9 @@
 # QNAP LCD Display and Button Class
 #
 import serial
+import time
+from collections import deque
+from concurrent.futures import Future
 from threading import *
 
 # Get ID       send=0x4d, 0x00  recv=0x53, 0x01, 0xXX, 0xYY
@@ -13,103 +16,236 @@ from threading import *
 # Negative ACK                  recv=0x53, 0xFB, 0xXX
 # Reset        send=0x4d, 0xFF
 
+PREAMBLES = (0x53, 0x83)
+
+# Length of each frame we can receive, preamble included, by command byte
+FRAME_LENGTHS = {
+    0x01: 4,  # Report_ID
+    0x05: 4,  # Switch_Status
+    0x08: 4,  # Protocol_Version
+    0xAA: 2,  # Reset_OK
+    0xFA: 2,  # Ack
+    0xFB: 3,  # Nack
+}
+
+# Response expected for each command we send. Anything else is ACKed.
+RESPONSES = {
+    0x00: 0x01,  # Get ID
+    0x06: 0x05,  # Get Button
+    0x07: 0x08,  # Get Protocol
+    0xFF: 0xAA,  # Reset
+}
+ACK = 0xFA
+NACK = 0xFB
+
+
+class LcdNack(Exception):
+    """The panel refused a command."""
+
+
 class QnapLCD:
-    def __init__(self, port='/dev/ttyS1', speed=1200, handler=None):
+    def __init__(self, port='/dev/ttyS1', speed=1200, handler=None,
+                 timeout=2.0, max_in_flight=4):
         self.port = port
         self.speed = speed
 
         self.lines = 2
         self.columns = 16
 
+        # Outstanding commands, oldest first, per response they wait for.
+        # Each entry is [future, deadline, command byte].
+        self.timeout = timeout
+        self.pending = {}
+        self.lock = Lock()
+        self.in_flight = BoundedSemaphore(max_in_flight)
+        self.buffer = bytearray()
+
         try:
-            self.connection = serial.Serial(self.port, self.speed, timeout=None)
+            # A short read timeout lets the reader expire overdue commands
+            self.connection = serial.Serial(self.port, self.speed, timeout=0.1)
         except serial.SerialException as se:
             self.connection = None
             print('error', se)
 
-        if handler:
-            self.handler = handler
-            self.reader = Thread(target=self.serial_reader)
-            self.reader.start()
-
-    def _read_bytes(self, bytes=1):
+        self.handler = handler
         if self.connection:
-            data = self.connection.read(bytes)
-            if bytes == 1:
-                return data[0]
+            self.reader = Thread(target=self.serial_reader, daemon=True)
+            self.reader.start()
 
-            return data
+    def _read_bytes(self):
+        # Whatever is available, waiting for at least one byte
+        connection = self.connection
+        if connection:
+            return connection.read(connection.in_waiting or 1)
 
         return None
 
+    def close(self):
+        # The reader stops within its read timeout, then the port is released
+        connection, self.connection = self.connection, None
+        if connection:
+            self.reader.join()
+            connection.close()
+        with self.lock:
+            pending = [entry for queue in self.pending.values() for entry in queue]
+            self.pending.clear()
+        for entry in pending:
+            self.in_flight.release()
+            entry[0].set_exception(ConnectionError(f'{self.port} was closed'))
+
     def serial_reader(self):
-        while True:
-            preamble = self._read_bytes()
-            if preamble == 0x53 or preamble == 0x83:
-                cmd =  self._read_bytes()
-                if cmd == 0x01:
-                    report = self._read_bytes(2)
-                    report = report[0] * 256 + report[1]
-                    self.handler('Report_ID', report)
-
-                if cmd == 0x05:
-                    buttons = self._read_bytes(2)
-                    buttons = buttons[0]*256 + buttons[1]
-                    self.handler('Switch_Status', buttons)
-
-                if cmd == 0x08:
-                    version = self._read_bytes(2)
-                    version = version[0]*256 + version[1]
-                    self.handler('Protocol_Version', version)
-
-                if cmd == 0xAA:
-                    self.handler('Reset_OK', True)
-
-                if cmd == 0xFA:
-                    #self.buffer = sport.read()
-                    self.handler('Ack', None)
-
-                if cmd == 0xFB:
-                    nack_cmd = self._read_bytes()
-                    self.handler('Nack', nack_cmd)
+        while self.connection:
+            try:
+                data = self._read_bytes()
+            except serial.SerialException as se:
+                print('error', se)
+                break
+            if data:
+                self.feed(data)
+            self._expire()
+
+    def feed(self, data):
+        # Frame parser. Garbage and truncated frames are skipped by
+        # resynchronizing on the next preamble.
+        self.buffer += data
+        while self.buffer:
+            if self.buffer[0] not in PREAMBLES:
+                starts = [i for i in (self.buffer.find(p) for p in PREAMBLES) if i >= 0]
+                del self.buffer[:min(starts) if starts else len(self.buffer)]
+                continue
+            if len(self.buffer) < 2:
+                return
+            length = FRAME_LENGTHS.get(self.buffer[1])
+            if length is None:
+                del self.buffer[0]
+                continue
+            if len(self.buffer) < length:
+                return
+            frame = bytes(self.buffer[:length])
+            del self.buffer[:length]
+            self._dispatch(frame[1], frame[2:])
+
+    def _dispatch(self, cmd, payload):
+        if cmd == 0x01:
+            self._event('Report_ID', payload[0] * 256 + payload[1], cmd)
+        elif cmd == 0x05:
+            self._event('Switch_Status', payload[0] * 256 + payload[1], cmd)
+        elif cmd == 0x08:
+            self._event('Protocol_Version', payload[0] * 256 + payload[1], cmd)
+        elif cmd == 0xAA:
+            self._event('Reset_OK', True, cmd)
+        elif cmd == ACK:
+            self._event('Ack', None, cmd)
+        elif cmd == NACK:
+            self._event('Nack', payload[0], cmd)
+
+    def _event(self, name, value, cmd):
+        if cmd == NACK:
+            # The NACK names the refused command, whatever response it
+            # waits for. Without a match, fail the oldest one waiting an ACK.
+            entry = self._pop_command(value) or self._pop(ACK)
+            if entry:
+                entry[0].set_exception(LcdNack(f'Command {entry[2]:#04x} refused'))
+        else:
+            entry = self._pop(cmd)
+            if entry:
+                entry[0].set_result(value)
+
+        # Unsolicited frames (e.g. a button press) are only seen by the handler
+        if self.handler:
+            self.handler(name, value)
+
+    def _pop(self, response):
+        with self.lock:
+            queue = self.pending.get(response)
+            if not queue:
+                return None
+            self.in_flight.release()
+            return queue.popleft()
+
+    def _pop_command(self, command):
+        # Oldest entry sent as command, in any queue
+        with self.lock:
+            matches = [(entry[1], response, entry)
+                       for response, queue in self.pending.items()
+                       for entry in queue if entry[2] == command]
+            if not matches:
+                return None
+            _, response, entry = min(matches, key=lambda match: match[0])
+            self.pending[response].remove(entry)
+            self.in_flight.release()
+            return entry
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for queue in self.pending.values():
+                while queue and queue[0][1] <= now:
+                    expired.append(queue.popleft())
+                    self.in_flight.release()
+        for entry in expired:
+            entry[0].set_exception(TimeoutError(f'Command {entry[2]:#04x} timed out'))
+
+    def _send(self, data):
+        # Returns a Future resolved by the matching response, ACK or NACK
+        future = Future()
+        if not self.connection:
+            future.set_exception(ConnectionError(f'{self.port} is not open'))
+            return future
+
+        # Only so many commands may be waiting for an answer at once
+        if not self.in_flight.acquire(timeout=self.timeout):
+            future.set_exception(TimeoutError('Too many commands in flight'))
+            return future
+        with self.lock:
+            response = RESPONSES.get(data[1], ACK)
+            entry = [future, time.monotonic() + self.timeout, data[1]]
+            self.pending.setdefault(response, deque()).append(entry)
+        try:
+            self.connection.write(data)
+        except serial.SerialException as se:
+            if self._drop(response, entry):
+                future.set_exception(se)
+        return future
+
+    def _drop(self, response, entry):
+        with self.lock:
+            if entry in self.pending.get(response, ()):
+                self.pending[response].remove(entry)
+                self.in_flight.release()
+                return True
+        return False
 
     def backlight(self, on=True):
-        if self.connection:
-            if on:
-                self.connection.write(bytes([0x4d, 0x5e, 0x01]))
-            else:
-                self.connection.write(bytes([0x4d, 0x5e, 0x00]))
+        if on:
+            return self._send(bytes([0x4d, 0x5e, 0x01]))
+        else:
+            return self._send(bytes([0x4d, 0x5e, 0x00]))
 
     def clear(self):
-        if self.connection:
-            self.connection.write(bytes([0x4d, 0x0d]))
+        return self._send(bytes([0x4d, 0x0d]))
 
     def reset(self):
-        if self.connection:
-            self.connection.write(bytes([0x4d, 0xff]))
+        return self._send(bytes([0x4d, 0xff]))
 
     def get_board(self):
-        if self.connection:
-            self.connection.write(bytes([0x4d, 0x00]))
+        return self._send(bytes([0x4d, 0x00]))
 
     def get_protocol(self):
-        if self.connection:
-            self.connection.write(bytes([0x4d, 0x07]))
+        return self._send(bytes([0x4d, 0x07]))
 
     def get_buttons(self):
-        if self.connection:
-            self.connection.write(bytes([0x4d, 0x06]))
+        return self._send(bytes([0x4d, 0x06]))
 
     def write(self, line, msg):
         # line is 1 or 2
         if isinstance(msg, list):
-            self.write(1, msg[0] if len(msg) >= 1 else '')
-            self.write(2, msg[1] if len(msg) >= 2 else '')
+            return [self.write(1, msg[0] if len(msg) >= 1 else ''),
+                    self.write(2, msg[1] if len(msg) >= 2 else '')]
         else:
             print(f'LINE {line}: {msg}')
             msg = msg[:self.columns]
             line %= 2
             line = 0x00 if line else 0x01
-            if self.connection:
-                self.connection.write(bytes([0x4d, 0x0c, line, len(msg)]))
-                self.connection.write(msg.encode('utf-8'))
+            return self._send(bytes([0x4d, 0x0c, line, len(msg)]) + msg.encode('utf-8'))
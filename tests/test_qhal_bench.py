@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: MIT
+
+"""Smoke test of the benchmark harness, against the simulated hardware."""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+BENCH = os.path.join(ROOT, 'tool', 'qhal_bench.py')
+
+
+class QhalBenchTest(unittest.TestCase):
+  """Runs every benchmark once, as short as possible."""
+
+  def test_short_run(self):
+    """All the benchmarks run and report their results."""
+    with tempfile.TemporaryDirectory() as tmp:
+      output = os.path.join(tmp, 'bench.json')
+      subprocess.run([sys.executable, BENCH, '--runs', '1', '--clients', '2', '--requests', '5',
+                      '--presses', '1', '--lcd-updates', '1', '--pattern-seconds', '0.1',
+                      '--output', output], check=True, timeout=300,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      with open(output) as f:
+        results = json.load(f)['results']
+    self.assertEqual(sorted(results), sorted(['cold_start_no_daemon', 'cold_start', 'ipc',
+                                              'button', 'leds', 'sensors', 'lcd']))
+    self.assertEqual(sorted(results['cold_start_no_daemon']), ['sensors', 'status', 'temp CPU'])
+    self.assertEqual(results['button']['release_to_command']['count'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
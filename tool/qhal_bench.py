@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+
+"""Benchmarks the hot paths of qhal against the simulated hardware.
+
+A private daemon is started with QHAL_BACKEND=sim, on its own socket, so this
+can run next to the real daemon. Results are printed as a JSON document, to
+be compared between revisions:
+
+  tool/qhal_bench.py --output before.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import pty
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+HAL_DIR = os.path.join(ROOT, 'src', 'hal')
+QHAL = os.path.join(HAL_DIR, 'qhal.py')
+
+# Subcommands timed from a cold start, and whether only the daemon serves
+# them: those fail without it, so they are only timed once it runs
+COLD_COMMANDS = [
+  (['status'], False),
+  (['led', 'Status_Green'], True),
+  (['led', 'Status_Green', 'on'], True),
+  (['temp', 'CPU'], False),
+  (['sensors'], False),
+  (['stats'], True),
+]
+
+
+def summary(samples):
+  """Summarize durations in seconds as milliseconds."""
+  if not samples:
+    return {'count': 0}
+  ordered = sorted(samples)
+
+  def pick(q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+  return {
+    'count': len(ordered),
+    'min': ordered[0] * 1000,
+    'p50': pick(0.5),
+    'p90': pick(0.9),
+    'p99': pick(0.99),
+    'max': ordered[-1] * 1000,
+    'mean': statistics.mean(ordered) * 1000,
+  }
+
+
+class Client:
+  """Minimal client of the daemon's newline-delimited JSON protocol."""
+
+  def __init__(self, path):
+    """Init."""
+    self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.__sock.connect(path)
+    self.__file = self.__sock.makefile('rb')
+    self.__id = 0
+
+  def close(self):
+    """Close the connection."""
+    self.__file.close()
+    self.__sock.close()
+
+  def send(self, cmd, *args):
+    """Send a request without waiting for its response."""
+    self.__id += 1
+    self.__sock.sendall(json.dumps({'id': self.__id, 'cmd': cmd, 'args': list(args)}).encode()
+                        + b'\n')
+
+  def receive(self):
+    """Wait for the next response."""
+    response = json.loads(self.__file.readline())
+    if not response.get('ok'):
+      raise RuntimeError(response.get('error'))
+    return response.get('result')
+
+  def request(self, cmd, *args):
+    """Send a request and wait for its response."""
+    self.send(cmd, *args)
+    return self.receive()
+
+
+class Bench:
+  """Runs the benchmarks against a simulated daemon."""
+
+  def __init__(self, args):
+    """Init."""
+    self.args = args
+    self.tmp = tempfile.mkdtemp(prefix='qhal_bench_')
+    self.socket = os.path.join(self.tmp, 'qhal.sock')
+    self.env = dict(os.environ,
+                    QHAL_BACKEND='sim',
+                    QHAL_SIM_DIR=os.path.join(self.tmp, 'sim'),
+                    QHAL_SOCKET=self.socket,
+                    QHAL_PID_FILE=os.path.join(self.tmp, 'qhal.pid'),
+                    QHAL_TEXTFILE_DIR='')
+
+  def qhal(self, *args):
+    """Run the qhal CLI. Returns its duration in seconds."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, QHAL] + list(args), env=self.env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+  def start_daemon(self):
+    """Start the daemon and wait for its socket."""
+    self.qhal('start')
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+      with contextlib.suppress(OSError):
+        Client(self.socket).close()
+        return
+      time.sleep(0.05)
+    raise RuntimeError('The daemon did not start')
+
+  def stop_daemon(self):
+    """Stop the daemon."""
+    with contextlib.suppress(subprocess.CalledProcessError):
+      self.qhal('stop')
+    deadline = time.monotonic() + 10
+    while os.path.exists(self.socket) and time.monotonic() < deadline:
+      time.sleep(0.05)
+
+  def close(self):
+    """Remove the temporary files."""
+    shutil.rmtree(self.tmp, ignore_errors=True)
+
+  def cold_start(self, daemon=True):
+    """Time each CLI subcommand, from process start to exit.
+
+    Without the daemon, only the subcommands the client serves itself are timed.
+    """
+    res = {}
+    for argv, needs_daemon in COLD_COMMANDS:
+      if needs_daemon and not daemon:
+        continue
+      res[' '.join(argv)] = summary([self.qhal(*argv) for _ in range(self.args.runs)])
+    return res
+
+  def ipc(self):
+    """Round-trip latency and throughput of N clients, each sending M requests."""
+    clients = [Client(self.socket) for _ in range(self.args.clients)]
+    latencies = [[] for _ in clients]
+    barrier = threading.Barrier(len(clients) + 1)
+
+    def work(client, samples):
+      barrier.wait()
+      for _ in range(self.args.requests):
+        start = time.perf_counter()
+        client.request('led', 'Status_Green')
+        samples.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=work, args=(client, samples))
+               for client, samples in zip(clients, latencies)]
+    for thread in threads:
+      thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+      thread.join()
+    elapsed = time.perf_counter() - start
+
+    # The same volume again, pipelined on one connection
+    client = clients[0]
+    total = self.args.clients * self.args.requests
+    pipelined = time.perf_counter()
+    for _ in range(total):
+      client.send('led', 'Status_Green')
+    for _ in range(total):
+      client.receive()
+    pipelined = time.perf_counter() - pipelined
+
+    for client in clients:
+      client.close()
+    return {
+      'clients': self.args.clients,
+      'requests_per_client': self.args.requests,
+      'latency': summary([sample for samples in latencies for sample in samples]),
+      'throughput_rps': total / elapsed,
+      'pipelined_throughput_rps': total / pipelined,
+    }
+
+  def button(self):
+    """Latency from a simulated button release to the bound command running."""
+    marker = os.path.join(self.tmp, 'button.marker')
+    client = Client(self.socket)
+    client.request('button', 'USB_Copy', '--', 'sh', '-c', f'echo > {marker}')
+    hold = 0.1
+    samples = []
+    # The daemon must see the button released once, or the first press is missed
+    time.sleep(0.2)
+    for _ in range(self.args.presses):
+      client.request('sim', 'press', 'USB_Copy', str(hold))
+      released = time.perf_counter() + hold
+      while not os.path.exists(marker):
+        if time.perf_counter() > released + 5:
+          raise RuntimeError('The button command did not run')
+        time.sleep(0.0005)
+      samples.append(time.perf_counter() - released)
+      os.remove(marker)
+      # Let the job be reaped, only one may run at once per button
+      time.sleep(0.1)
+    client.close()
+    return {'hold_seconds': hold, 'release_to_command': summary(samples)}
+
+  def leds(self):
+    """Cost of LED updates, in time and register accesses."""
+    client = Client(self.socket)
+    names = list(client.request('sim', 'show')['leds'])
+    before = client.request('stats').get('port', {}).get('writes', 0)
+    samples = []
+    for n in range(self.args.requests):
+      state = 'on' if n % 2 else 'off'
+      start = time.perf_counter()
+      for name in names:
+        client.send('led', name, state)
+      for _ in names:
+        client.receive()
+      samples.append(time.perf_counter() - start)
+    after = client.request('stats').get('port', {}).get('writes', 0)
+    updates = self.args.requests * len(names)
+
+    # Every LED blinking at 10 Hz
+    for name in names:
+      client.request('led', name, 'blink', '10')
+    time.sleep(self.args.pattern_seconds)
+    stats = client.request('stats')
+    for name in names:
+      client.request('led', name, 'off')
+    client.close()
+    return {
+      'leds': len(names),
+      'all_leds_round_trip': summary(samples),
+      # Reads are left out, the button sampling keeps reading in the background
+      'register_writes_per_update': (after - before) / updates,
+      'pattern_tick': stats.get('leds', {}).get('pattern_tick'),
+      'pattern_edges': stats.get('leds', {}).get('pattern_edges'),
+    }
+
+  def sensors(self):
+    """Cost of reading a chip through `sensors -u`, sysfs and the daemon."""
+    root = os.path.join(self.tmp, 'sim', 'class', 'hwmon')
+    files = [os.path.join(root, hwmon, key) for hwmon in sorted(os.listdir(root))
+             for key in sorted(os.listdir(os.path.join(root, hwmon))) if key.endswith('_input')]
+    direct = []
+    for _ in range(self.args.requests):
+      start = time.perf_counter()
+      for path in files:
+        with open(path) as f:
+          int(f.read())
+      direct.append(time.perf_counter() - start)
+
+    res = {'sysfs_files': len(files), 'direct_all': summary(direct)}
+    if shutil.which('sensors'):
+      spawned = []
+      for _ in range(self.args.runs):
+        start = time.perf_counter()
+        subprocess.run(['sensors', '-u'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        spawned.append(time.perf_counter() - start)
+      res['subprocess_all'] = summary(spawned)
+    else:
+      res['subprocess_all'] = None
+
+    client = Client(self.socket)
+    cached = []
+    for _ in range(self.args.requests):
+      start = time.perf_counter()
+      client.request('sensor', 'all')
+      cached.append(time.perf_counter() - start)
+    client.close()
+    res['daemon_all'] = summary(cached)
+    return res
+
+  def lcd(self):
+    """Time to update the LCD over the emulated 1200 baud line."""
+    client = Client(self.socket)
+    port = None
+    samples = []
+    for n in range(self.args.lcd_updates):
+      start = time.perf_counter()
+      client.request('lcd', 'write', f'Update {n}', f'Row {n}')
+      while True:
+        lcds = client.request('sim', 'show')['lcd']
+        port = port or next(iter(lcds))
+        if lcds[port]['out_waiting'] == 0:
+          break
+        time.sleep(0.005)
+      samples.append(time.perf_counter() - start)
+    # Unchanged rows are not sent again
+    start = time.perf_counter()
+    client.request('lcd', 'write', f'Update {n}', f'Row {n}')
+    unchanged = time.perf_counter() - start
+    client.close()
+    return {'daemon_two_rows': summary(samples), 'daemon_unchanged': unchanged * 1000,
+            'qnaplcd': self.qnaplcd()}
+
+  def qnaplcd(self):
+    """Time for QnapLCD commands to be acknowledged, one by one and pipelined."""
+    sys.path.insert(0, HAL_DIR)
+    import qhalsim
+    from qnaplcd import QnapLCD
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    panel = qhalsim.LcdSim(1200, None)
+    running = True
+
+    def receive():
+      while running:
+        with contextlib.suppress(OSError):
+          panel.write(os.read(master, 64))
+
+    def answer():
+      while running:
+        data = panel.read(1)
+        with contextlib.suppress(OSError):
+          os.write(master, data)
+
+    for target in (receive, answer):
+      threading.Thread(target=target, daemon=True).start()
+
+    # QnapLCD traces every write on stdout, which holds our results
+    with contextlib.redirect_stdout(io.StringIO()):
+      lcd = QnapLCD(os.ttyname(slave), 1200, timeout=5)
+      sequential = []
+      for n in range(self.args.lcd_updates):
+        start = time.perf_counter()
+        lcd.write(1, f'Update {n}').result()
+        sequential.append(time.perf_counter() - start)
+      start = time.perf_counter()
+      for future in [lcd.write(1 + n % 2, f'Update {n}') for n in range(self.args.lcd_updates)]:
+        future.result()
+      pipelined = (time.perf_counter() - start) / self.args.lcd_updates
+    running = False
+    lcd.close()
+    return {'row_acked': summary(sequential), 'row_pipelined_ms': pipelined * 1000}
+
+
+BENCHMARKS = ['cold_start', 'ipc', 'button', 'leds', 'sensors', 'lcd']
+
+
+def git_revision():
+  """Return the current commit, if any."""
+  res = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL, universal_newlines=True)
+  return res.stdout.strip() or None
+
+
+def parse():
+  """Parse the command line arguments."""
+  parser = argparse.ArgumentParser(description='Benchmark qhal against the simulated hardware')
+  parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                      help='Benchmarks to run')
+  parser.add_argument('--runs', type=int, default=10, help='Process spawns per measure')
+  parser.add_argument('--clients', type=int, default=8, help='Concurrent IPC clients')
+  parser.add_argument('--requests', type=int, default=200, help='Requests per client')
+  parser.add_argument('--presses', type=int, default=20, help='Simulated button presses')
+  parser.add_argument('--lcd-updates', type=int, default=5, help='LCD updates')
+  parser.add_argument('--pattern-seconds', type=float, default=2.0,
+                      help='How long all LEDs blink')
+  parser.add_argument('--output', help='Write the results to this file instead of stdout')
+  return parser.parse_args()
+
+
+def main():
+  """Start execution here."""
+  args = parse()
+  bench = Bench(args)
+  results = {}
+  try:
+    if 'cold_start' in args.only:
+      results['cold_start_no_daemon'] = bench.cold_start(daemon=False)
+    bench.start_daemon()
+    for name in args.only:
+      results[name] = getattr(bench, name)()
+  finally:
+    bench.stop_daemon()
+    bench.close()
+
+  report = {
+    'meta': {
+      'revision': git_revision(),
+      'time': time.time(),
+      'python': platform.python_version(),
+      'machine': platform.machine(),
+      'parameters': {name: value for name, value in vars(args).items() if name != 'output'},
+    },
+    'results': results,
+  }
+  text = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(text + '\n')
+  else:
+    print(text)
+
+
+if __name__ == '__main__':
+  main()